@@ -7,14 +7,26 @@
 
 import urllib
 import urllib2
+import httplib
+import socket
+import errno
+import threading
+import Queue
 import re
 import logging
 import time
 import sys
 import MultipartPostHandler
 import traceback
-from collections import Iterable
+import copy
+import sqlite3
+from collections import Iterable, OrderedDict, deque
 from datetime import date
+from urlparse import urlsplit
+from cStringIO import StringIO
+from tornado import gen
+import tornado.httpclient
+import tornado.ioloop
 
 logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
     datefmt='%d-%m-%Y:%H:%M:%S',
@@ -37,12 +49,1163 @@ except ImportError:
     from cgi import parse_qs
 
 
+GENI_HOST = "www.geni.com"
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive HTTPS connections to the Geni host.
+
+    urlopen() behaves like urllib2.urlopen for the calls GeniAPI makes: it
+    returns a file-like response with info() and raises urllib2.HTTPError for
+    error statuses, but reuses idle connections instead of paying a new TCP
+    and TLS handshake on every call.  URLs for other hosts go to urllib2.
+    """
+
+    def __init__(self, host=GENI_HOST, maxsize=10, timeout=60):
+        self.host = host
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue(maxsize)
+
+    def _get_conn(self):
+        try:
+            return self.idle.get_nowait(), True
+        except Queue.Empty:
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout), False
+
+    def _put_conn(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def _stale(self, e, sent):
+        """True for the errors of an idle connection the server has dropped:
+        reset or broken pipe while sending, or closed before any of the
+        response arrived.  A timeout is never one of them."""
+        if isinstance(e, socket.timeout):
+            return False
+        if isinstance(e, httplib.BadStatusLine):
+            line = e.line or ""
+            return sent and (line in ("", "''") or line.startswith("No status line"))
+        if isinstance(e, socket.error) and not sent:
+            return e.errno in (errno.ECONNRESET, errno.EPIPE)
+        return False
+
+    def urlopen(self, url, data=None):
+        parts = urlsplit(url)
+        if parts.scheme != "https" or parts.netloc != self.host:
+            return urllib2.urlopen(url, data)
+        selector = parts.path
+        if parts.query:
+            selector += "?" + parts.query
+        headers = {"Connection": "keep-alive"}
+        if data is not None:
+            method = "POST"
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        else:
+            method = "GET"
+        conn, reused = self._get_conn()
+        while True:
+            sent = False
+            try:
+                conn.request(method, selector, data, headers)
+                sent = True
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                #The server may have dropped an idle connection - retry a GET once on a fresh one
+                if not reused or method != "GET" or not self._stale(e, sent):
+                    raise urllib2.URLError(e)
+                conn, reused = httplib.HTTPSConnection(self.host, timeout=self.timeout), False
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_conn(conn)
+        if response.status in (301, 302, 303, 307) and response.getheader("location"):
+            return self.urlopen(response.getheader("location"))
+        fp = StringIO(body)
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, fp)
+        return urllib.addinfourl(fp, response.msg, url, response.status)
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def connection_pool(options=None):
+    """Return the process-wide ConnectionPool, sized by options.geni_pool_size."""
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            maxsize = getattr(options, "geni_pool_size", None) or 10
+            _connection_pool = ConnectionPool(GENI_HOST, maxsize)
+        return _connection_pool
+
+
+class RateLimiter(object):
+    """Token bucket shared by every Geni call in the process.
+
+    The process bucket refills at rate requests per second up to burst.  Each
+    key (an access token, so one per user job) also has its own bucket that
+    refills at an equal share of the rate among the keys active in the last
+    idle seconds, so a 30 thread crawl can't starve a smaller job.  Geni's
+    X-API-Rate-* response headers override the configured rate when present.
+
+    Interactive calls (page requests, as opposed to crawl tasks) only draw on
+    the process bucket, and one that has to wait holds the next token, so
+    background callers back off until it has been served.  Holding spends the
+    priority lane's own bucket, which refills at the priority share of the
+    rate, so page requests can't keep the crawls waiting for longer than that.
+    """
+
+    def __init__(self, rate=4.0, burst=40, idle=10, priority=0.5):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.idle = idle
+        self.priority = priority
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.lane = max(1.0, self.burst * priority)
+        self.stamp = time.time()
+        self.keys = {}
+        self.held = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.lane = min(max(1.0, self.burst * self.priority), self.lane + (now - self.stamp) * self.rate * self.priority)
+        self.stamp = now
+        for key in self.keys.keys():
+            if now - self.keys[key]["seen"] > self.idle:
+                del self.keys[key]
+
+    def _key(self, key, now):
+        if key not in self.keys:
+            self.keys[key] = {"tokens": 1.0, "stamp": now, "seen": now}
+        bucket = self.keys[key]
+        share = self.rate / len(self.keys)
+        capacity = max(1.0, self.burst / len(self.keys))
+        bucket["tokens"] = min(capacity, bucket["tokens"] + (now - bucket["stamp"]) * share)
+        bucket["stamp"] = now
+        bucket["seen"] = now
+        return bucket, share
+
+    def reserve(self, key=None, interactive=False):
+        """Take a slot for key if one is free.  Returns 0 on success, otherwise
+        the number of seconds to wait before asking again."""
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if interactive:
+                if self.tokens >= 1 and (self.lane >= 1 or now >= self.held):
+                    self.tokens -= 1
+                    self.lane = max(0.0, self.lane - 1)
+                    self.held = 0
+                    return 0
+                wait = max((1 - self.tokens) / self.rate, 0.01)
+                if self.lane < 1:
+                    # The lane is spent - wait in line with the crawls
+                    return max(wait, self.held - now)
+                # Keep the token for a moment past the wait, as the caller may wake late
+                self.held = max(self.held, now + wait + 0.1)
+                return wait
+            if now < self.held:
+                return max(self.held - now, 0.01)
+            bucket, share = self._key(key, now)
+            if self.tokens >= 1 and bucket["tokens"] >= 1:
+                self.tokens -= 1
+                bucket["tokens"] -= 1
+                return 0
+            return max((1 - self.tokens) / self.rate, (1 - bucket["tokens"]) / share, 0.01)
+
+    def acquire(self, key=None, interactive=False):
+        wait = self.reserve(key, interactive)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve(key, interactive)
+
+    def update(self, key, headers):
+        """Adopt the limits Geni reports in its response headers."""
+        if not headers:
+            return
+        try:
+            limit = headers.get("X-API-Rate-Limit")
+            window = headers.get("X-API-Rate-Window")
+            remaining = headers.get("X-API-Rate-Remaining")
+            with self.lock:
+                if limit and window and float(window) > 0:
+                    self.rate = float(limit) / float(window)
+                    self.burst = float(limit)
+                if remaining is not None and key in self.keys:
+                    bucket = self.keys[key]
+                    bucket["tokens"] = min(bucket["tokens"], float(remaining))
+        except (TypeError, ValueError):
+            pass
+
+    def throttle(self, key=None):
+        """Geni rejected a call - drain the buckets so every caller backs off
+        for about a second instead of retrying into the limit."""
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0) - self.rate
+            if key in self.keys:
+                self.keys[key]["tokens"] = min(self.keys[key]["tokens"], 0)
+
+
+_rate_limiter = None
+
+
+def rate_limiter(options=None):
+    """Return the process-wide RateLimiter, set by options.geni_rate_limit,
+    geni_rate_burst and geni_priority_share."""
+    global _rate_limiter
+    with _connection_pool_lock:
+        if _rate_limiter is None:
+            rate = getattr(options, "geni_rate_limit", None) or 4.0
+            burst = getattr(options, "geni_rate_burst", None) or 40
+            priority = getattr(options, "geni_priority_share", None) or 0.5
+            _rate_limiter = RateLimiter(rate, burst, priority=priority)
+        return _rate_limiter
+
+
+# Marks a thread serving page requests, whose Geni calls go ahead of background work
+_interactive = threading.local()
+
+
+def set_interactive(on=True):
+    """Mark the Geni calls of the calling thread as made for a page request."""
+    _interactive.on = on
+
+
+def is_interactive():
+    return getattr(_interactive, "on", False)
+
+
+class ScheduledTask(object):
+    def __init__(self, user, function, args, cost):
+        self.user = user
+        self.function = function
+        self.args = args
+        self.cost = cost
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+            logging.exception("Scheduled task failed")
+        self.done.set()
+
+    def result(self):
+        """Block until the task has run and return what it returned, or raise what it raised."""
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class CrawlScheduler(object):
+    """Process-wide set of threads running the Geni calls of every user's
+    background jobs (history search slices, graph chunks).
+
+    Each user has a queue of tasks.  Free threads serve the users by deficit
+    round robin: a user's turn adds quantum to its credit and a task runs once
+    the credit covers its cost, the number of ids it looks up, so users get
+    the same share of lookups whatever their batch sizes.  No user runs more
+    than cap tasks at once.  Page requests don't queue here; they get ahead
+    of these threads at the RateLimiter instead.
+    """
+
+    def __init__(self, slots=30, cap=15, quantum=20):
+        self.slots = slots
+        self.cap = cap
+        self.quantum = quantum
+        self.ready = threading.Condition()
+        self.queues = {}
+        self.credit = {}
+        self.running = {}
+        # Users with queued tasks, the head of it has the turn
+        self.order = deque()
+        self.threads = []
+        for i in range(slots):
+            thread = threading.Thread(target=self.work, name="crawl-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, user, function, *args, **kwargs):
+        """Queue function(*args) for user and return its ScheduledTask.  cost
+        (a keyword, default 1) is what the task counts against the user's share."""
+        task = ScheduledTask(user, function, args, kwargs.get("cost", 1))
+        with self.ready:
+            if user not in self.queues:
+                self.queues[user] = deque()
+                self.credit[user] = 0
+                self.order.append(user)
+            self.queues[user].append(task)
+            self.ready.notify()
+        return task
+
+    def capped(self, user):
+        return self.running.get(user, 0) >= self.cap
+
+    def next_task(self):
+        """The next task by deficit round robin, or None when every user with
+        queued tasks is at its cap."""
+        skipped = 0
+        while self.order and skipped < len(self.order):
+            user = self.order[0]
+            if self.capped(user):
+                skipped += 1
+            else:
+                skipped = 0
+                queue = self.queues[user]
+                if self.credit[user] >= queue[0].cost:
+                    task = queue.popleft()
+                    self.credit[user] -= task.cost
+                    if not queue:
+                        del self.queues[user]
+                        del self.credit[user]
+                        self.order.popleft()
+                    return task
+            # The turn passes on, with a fresh quantum for the next user
+            self.order.rotate(-1)
+            if not self.capped(self.order[0]):
+                self.credit[self.order[0]] += self.quantum
+        return None
+
+    def work(self):
+        while True:
+            with self.ready:
+                task = self.next_task()
+                while task is None:
+                    self.ready.wait()
+                    task = self.next_task()
+                self.running[task.user] = self.running.get(task.user, 0) + 1
+            task.run()
+            with self.ready:
+                self.running[task.user] -= 1
+                if not self.running[task.user]:
+                    del self.running[task.user]
+                # The user may have been at its cap with tasks waiting
+                self.ready.notify()
+
+    def stats(self):
+        with self.ready:
+            return {"queued": sum(len(queue) for queue in self.queues.values()),
+                    "running": sum(self.running.values()), "users": len(set(self.queues) | set(self.running))}
+
+
+_crawl_scheduler = None
+
+
+def crawl_scheduler(options=None):
+    """Return the process-wide CrawlScheduler, sized by options.geni_slots,
+    geni_user_slots and geni_scheduler_quantum."""
+    global _crawl_scheduler
+    with _connection_pool_lock:
+        if _crawl_scheduler is None:
+            slots = getattr(options, "geni_slots", None) or 30
+            cap = getattr(options, "geni_user_slots", None) or 15
+            quantum = getattr(options, "geni_scheduler_quantum", None) or 20
+            _crawl_scheduler = CrawlScheduler(slots, cap, quantum)
+        return _crawl_scheduler
+
+
+def is_shareable(response):
+    """True if a response holds nothing that depends on who asked for it -
+    no error, and every profile in it is public."""
+    if not isinstance(response, dict) or not response or "error" in response:
+        return False
+    stack = [response]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            id = item.get("id")
+            if isinstance(id, basestring) and id.startswith("profile-") and item.get("public") is not True:
+                return False
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return True
+
+
+class Flight(object):
+    def __init__(self, token):
+        self.token = token
+        self.done = threading.Event()
+        self.response = None
+        self.waiters = 0
+
+
+class RequestCoalescer(object):
+    """Single-flight table for GETs.
+
+    Identical requests (same path and args, ignoring the access token) that
+    arrive while one is in flight wait for it instead of calling Geni again.
+    A waiter with the same token always gets the result; other users only get
+    it when it is shareable, and otherwise make their own call.  Every caller
+    gets its own copy, since Family and Relative annotate the dicts they parse.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def key(self, path, args):
+        args = args or {}
+        return path + "?" + urllib.urlencode(sorted((k, v) for k, v in args.items() if k != "access_token"))
+
+    def join(self, key, token):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight:
+                flight.waiters += 1
+                return flight, False
+            flight = Flight(token)
+            flight.key = key
+            self.flights[key] = flight
+            return flight, True
+
+    def finish(self, flight, response):
+        with self.lock:
+            del self.flights[flight.key]
+            waiters = flight.waiters
+        if waiters > 0 and response is not None:
+            flight.response = response
+            response = copy.deepcopy(response)
+        flight.done.set()
+        return response
+
+    def wait(self, flight, token):
+        flight.done.wait()
+        if flight.response is None:
+            return None
+        if flight.token == token or is_shareable(flight.response):
+            return copy.deepcopy(flight.response)
+        return None
+
+
+_request_coalescer = RequestCoalescer()
+
+# Seconds a cached result stays fresh, by endpoint
+CACHE_TTLS = {
+    "profile/immediate-family": 900,
+    "profile": 900,
+}
+
+
+def profile_id(id):
+    """Canonical integer form of a profile id given as "profile-123", "123" or 123.
+
+    This is the one place ids coming from Geni or the browser are converted;
+    anything that is not a numeric profile id (a guid, the "profile" alias
+    for the current user) is returned unchanged.
+    """
+    if isinstance(id, (int, long)):
+        return id
+    number = id[8:] if id.startswith("profile-") else id
+    if number.isdigit():
+        return int(number)
+    return id
+
+
+def profile_key(id):
+    """The "profile-123" form of a profile id that Geni paths and links use."""
+    if isinstance(id, (int, long)):
+        return "profile-%d" % id
+    if id.startswith("profile"):
+        return id
+    return "profile-" + id
+
+
+def cache_id(item):
+    """The profile id a per-profile result is about, without the "profile-" prefix."""
+    if "focus" in item and "id" in item["focus"]:
+        item = item["focus"]
+    return str(item.get("id", "")).replace("profile-", "")
+
+
+class DeniedCache(object):
+    """Profiles a user was refused with Access Denied, remembered for ttl seconds.
+
+    Entries are keyed on access token and profile id and hold the profile
+    lookup that showed the profile as private, so a denied Family can be
+    built without asking Geni again.  The counters show how many calls
+    isolating denied profiles costs.
+    """
+
+    def __init__(self, ttl=3600, maxentries=100000):
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counts = {"filtered": 0, "refused": 0, "probes": 0, "retries": 0, "lookups": 0, "denied": 0}
+
+    def get(self, token, id):
+        key = (token, str(id).replace("profile-", ""))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[key]
+                return None
+            self.counts["filtered"] += 1
+            return entry[0]
+
+    def put(self, token, id, profile):
+        key = (token, str(id).replace("profile-", ""))
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (profile, time.time() + self.ttl)
+            self.counts["denied"] += 1
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats["entries"] = len(self.entries)
+        return stats
+
+
+_denied_cache = None
+
+
+def denied_cache(options=None):
+    """Return the process-wide DeniedCache, expiring entries after options.geni_denied_ttl seconds."""
+    global _denied_cache
+    with _connection_pool_lock:
+        if _denied_cache is None:
+            _denied_cache = DeniedCache(getattr(options, "geni_denied_ttl", None) or 3600)
+        return _denied_cache
+
+
+class ResponseCache(object):
+    """Memory-bounded LRU cache of per-profile Geni results.
+
+    Entries are keyed on endpoint, profile id and the rest of the query (the
+    field set), and are kept as JSON text so the size is known and every hit
+    parses a fresh copy.  Results that are only visible to some users are
+    scoped to the access token that fetched them.  Entries expire after the
+    endpoint's TTL in CACHE_TTLS.  With a DiskCache attached, shared entries
+    are written through to disk and memory misses are looked up there.
+    """
+
+    def __init__(self, maxbytes=32 * 1024 * 1024, ttls=None, disk=None):
+        self.maxbytes = maxbytes
+        self.ttls = ttls or CACHE_TTLS
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def variant(self, args):
+        return urllib.urlencode(sorted((k, v) for k, v in args.items() if k not in ("ids", "access_token")))
+
+    def get(self, endpoint, id, variant, token=None):
+        id = str(id).replace("profile-", "")
+        now = time.time()
+        with self.lock:
+            for scope in (None, token):
+                key = (endpoint, id, variant, scope)
+                entry = self.entries.pop(key, None)
+                if entry is None:
+                    continue
+                if entry[1] < now:
+                    self.bytes -= len(entry[0])
+                    continue
+                self.entries[key] = entry
+                self.hits += 1
+                body = entry[0]
+                break
+            else:
+                body = self.load(endpoint, id, variant)
+                if body is None:
+                    self.misses += 1
+                    return None
+        return _parse_json(body)
+
+    def load(self, endpoint, id, variant):
+        """Look for a shared entry on disk - called with the lock held."""
+        if not self.disk:
+            return None
+        row = self.disk.get(endpoint, id, variant)
+        if not row:
+            return None
+        key = (endpoint, id, variant, None)
+        self.entries[key] = row
+        self.bytes += len(row[0])
+        self.disk_hits += 1
+        self.evict()
+        return row[0]
+
+    def evict(self):
+        while self.bytes > self.maxbytes and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.bytes -= len(entry[0])
+            self.evictions += 1
+
+    def warm(self):
+        """Fill up to half the memory budget from the most recently used disk entries."""
+        if not self.disk:
+            return
+        with self.lock:
+            for endpoint, id, variant, body, expires in self.disk.recent(self.maxbytes / 2):
+                key = (endpoint, id, variant, None)
+                if key not in self.entries:
+                    self.entries[key] = (body, expires)
+                    self.bytes += len(body)
+            self.evict()
+
+    def put(self, endpoint, id, variant, item, token=None):
+        if not id or endpoint not in self.ttls:
+            return
+        scope = None if is_shareable(item) else token
+        key = (endpoint, id, variant, scope)
+        body = json.dumps(item)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.bytes -= len(old[0])
+            expires = time.time() + self.ttls[endpoint]
+            self.entries[key] = (body, expires)
+            self.bytes += len(body)
+            self.evict()
+        if scope is None and self.disk:
+            self.disk.put(endpoint, id, variant, body, expires)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            stats = {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits,
+                     "disk_hits": self.disk_hits, "misses": self.misses, "evictions": self.evictions,
+                     "hit_rate": float(self.hits + self.disk_hits) / lookups if lookups else 0.0}
+        if self.disk:
+            stats["disk_bytes"] = self.disk.bytes
+        return stats
+
+
+class DiskCache(object):
+    """SQLite tier behind ResponseCache that survives restarts.
+
+    Only results that are not tied to one user's access are stored.  Rows
+    carry their expiry time and are purged on startup; when the file holds
+    more than maxbytes of results the least recently used rows are removed.
+    """
+
+    def __init__(self, path, maxbytes=256 * 1024 * 1024):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.text_factory = str
+        with self.lock:
+            self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (endpoint TEXT, id TEXT, variant TEXT, "
+                            "body TEXT, expires REAL, used REAL, PRIMARY KEY (endpoint, id, variant))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+            self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self.bytes = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+
+    def get(self, endpoint, id, variant):
+        now = time.time()
+        try:
+            with self.lock:
+                row = self.db.execute("SELECT body, expires FROM responses WHERE endpoint=? AND id=? AND variant=?",
+                                      (endpoint, id, variant)).fetchone()
+                if row and row[1] >= now:
+                    self.db.execute("UPDATE responses SET used=? WHERE endpoint=? AND id=? AND variant=?",
+                                    (now, endpoint, id, variant))
+                    return row
+        except sqlite3.Error:
+            logging.warning("****** Problem reading cache " + self.path + " ******")
+            traceback.print_exc()
+        return None
+
+    def put(self, endpoint, id, variant, body, expires):
+        try:
+            with self.lock:
+                old = self.db.execute("SELECT LENGTH(body) FROM responses WHERE endpoint=? AND id=? AND variant=?",
+                                      (endpoint, id, variant)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                (endpoint, id, variant, body, expires, time.time()))
+                self.bytes += len(body) - (old[0] if old else 0)
+                if self.bytes > self.maxbytes:
+                    self.compact()
+        except sqlite3.Error:
+            logging.warning("****** Problem writing cache " + self.path + " ******")
+            traceback.print_exc()
+
+    def compact(self):
+        """Drop expired rows, then least recently used ones down to 80% of maxbytes - called with the lock held."""
+        self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+        self.bytes = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+        target = self.maxbytes * 0.8
+        while self.bytes > target:
+            rows = self.db.execute("SELECT endpoint, id, variant, LENGTH(body) FROM responses ORDER BY used LIMIT 500").fetchall()
+            if not rows:
+                break
+            for endpoint, id, variant, size in rows:
+                self.db.execute("DELETE FROM responses WHERE endpoint=? AND id=? AND variant=?", (endpoint, id, variant))
+                self.bytes -= size
+                if self.bytes <= target:
+                    break
+        self.db.execute("PRAGMA incremental_vacuum")
+
+    def recent(self, maxbytes):
+        """The most recently used live rows, up to maxbytes of results."""
+        rows = []
+        total = 0
+        try:
+            with self.lock:
+                cursor = self.db.execute("SELECT endpoint, id, variant, body, expires FROM responses "
+                                         "WHERE expires >= ? ORDER BY used DESC", (time.time(),))
+                for row in cursor:
+                    total += len(row[3])
+                    if total > maxbytes:
+                        break
+                    rows.append(row)
+        except sqlite3.Error:
+            logging.warning("****** Problem loading cache " + self.path + " ******")
+            traceback.print_exc()
+        rows.reverse()
+        return rows
+
+
+_response_cache = None
+
+
+def response_cache(options=None):
+    """Return the process-wide ResponseCache, capped at options.geni_cache_mb megabytes
+    and backed by a DiskCache at options.geni_cache_path when that is set."""
+    global _response_cache
+    with _connection_pool_lock:
+        if _response_cache is None:
+            size = getattr(options, "geni_cache_mb", None) or 32
+            disk = None
+            path = getattr(options, "geni_cache_path", None)
+            if path:
+                disksize = getattr(options, "geni_cache_disk_mb", None) or 256
+                disk = DiskCache(path, disksize * 1024 * 1024)
+            _response_cache = ResponseCache(size * 1024 * 1024, disk=disk)
+            _response_cache.warm()
+        return _response_cache
+
+
+class CircuitBreaker(object):
+    """Stops calling Geni while it is down or too slow to be useful.
+
+    The outcomes of the last window calls are kept; a call fails when it
+    raises, gets a 5xx or takes longer than slow seconds.  Once threshold of
+    them have failed the breaker opens and calls fail fast for cooldown
+    seconds.  It then goes half-open and lets probes calls through at a time:
+    a success closes it again, a failure reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=10, window=20, slow=30.0, cooldown=30.0, probes=1):
+        self.threshold = threshold
+        self.window = window
+        self.slow = slow
+        self.cooldown = cooldown
+        self.probes = probes
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.outcomes = []
+        self.opened = 0
+        self.probing = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Whether a call may go to Geni now.  Every allowed call must be
+        followed by record()."""
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened < self.cooldown:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = 0
+            if self.state == self.HALF_OPEN:
+                if self.probing >= self.probes:
+                    self.rejected += 1
+                    return False
+                self.probing += 1
+            return True
+
+    def record(self, success, elapsed=0):
+        failed = not success or elapsed > self.slow
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = max(0, self.probing - 1)
+                if failed:
+                    self.trip()
+                else:
+                    self.state = self.CLOSED
+                    self.outcomes = []
+                return
+            self.outcomes.append(failed)
+            del self.outcomes[:-self.window]
+            if self.state == self.CLOSED and sum(self.outcomes) >= self.threshold:
+                self.trip()
+
+    def trip(self):
+        if self.state != self.OPEN:
+            logging.warning("****** Geni unavailable - pausing calls for " + str(self.cooldown) + " seconds ******")
+        self.state = self.OPEN
+        self.opened = time.time()
+        self.outcomes = []
+
+    def is_open(self):
+        with self.lock:
+            return self.state == self.OPEN
+
+    def stats(self):
+        with self.lock:
+            return {"state": self.state, "failures": sum(self.outcomes), "calls": len(self.outcomes),
+                    "rejected": self.rejected}
+
+
+_circuit_breaker = None
+
+
+def circuit_breaker(options=None):
+    """Return the process-wide CircuitBreaker, configured from the geni_breaker_* options."""
+    global _circuit_breaker
+    with _connection_pool_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker(getattr(options, "geni_breaker_threshold", None) or 10,
+                                              getattr(options, "geni_breaker_window", None) or 20,
+                                              getattr(options, "geni_breaker_slow", None) or 30.0,
+                                              getattr(options, "geni_breaker_cooldown", None) or 30.0)
+        return _circuit_breaker
+
+
+def unavailable():
+    """The error response returned in place of a call while the breaker is open."""
+    return {"error": {"type": "GeniUnavailable", "message": "Geni unavailable"}}
+
+
+class Token(object):
+    def __init__(self, access_token, refresh_token=None, expires=None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires = expires
+        self.used = time.time()
+        self.lock = threading.Lock()
+
+
+class TokenManager(object):
+    """OAuth tokens shared by every client and worker of one user.
+
+    A refresh happens behind the token's lock: callers holding the same stale
+    access token wait for that one refresh and then use its result instead of
+    refreshing again.  Old access tokens keep pointing at the current one.
+    When the expiry time is known (register at login) the token is refreshed
+    margin seconds before it runs out.
+    """
+
+    def __init__(self, client_id, client_secret, margin=300, pool=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.margin = margin
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.swept = time.time()
+
+    def token(self, access_token, refresh_token=None):
+        now = time.time()
+        with self.lock:
+            if now - self.swept > 3600:
+                for key, token in self.tokens.items():
+                    if now - token.used > 86400:
+                        del self.tokens[key]
+                self.swept = now
+            token = self.tokens.get(access_token)
+            if token is None:
+                token = Token(access_token, refresh_token)
+                self.tokens[access_token] = token
+            elif refresh_token and not token.refresh_token:
+                token.refresh_token = refresh_token
+            token.used = now
+            return token
+
+    def register(self, access_token, refresh_token, expires_in=None):
+        token = self.token(access_token, refresh_token)
+        if expires_in:
+            token.expires = time.time() + int(expires_in)
+
+    def latest(self, access_token):
+        """The current (access token, refresh token) for access_token, without refreshing."""
+        with self.lock:
+            token = self.tokens.get(access_token)
+            if token is None:
+                return None
+            return token.access_token, token.refresh_token
+
+    def due(self, token):
+        return token.refresh_token and token.expires and token.expires - self.margin < time.time()
+
+    def current(self, access_token, refresh_token=None):
+        """The (access token, refresh token) to use for access_token, refreshed
+        first when it is about to expire."""
+        token = self.token(access_token, refresh_token)
+        if self.due(token):
+            self.refresh(token.access_token)
+        return token.access_token, token.refresh_token
+
+    def refresh_url(self, token):
+        return "https://www.geni.com/platform/oauth/request_token?" + urllib.urlencode({
+            "refresh_token": token.refresh_token,
+            "grant_type": "refresh_token",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            })
+
+    def refresh(self, stale):
+        """Replace the stale access token.  Returns the new (access token,
+        refresh token), or None when Geni refused the refresh."""
+        token = self.token(stale)
+        with token.lock:
+            if token.access_token != stale:
+                return token.access_token, token.refresh_token
+            if not token.refresh_token:
+                return None
+            try:
+                file = self.pool.urlopen(self.refresh_url(token))
+                try:
+                    redata = file.read()
+                finally:
+                    file.close()
+            except urllib2.HTTPError, e:
+                redata = e.read()
+            except:
+                logging.warning("****** Problem refreshing access token ******")
+                traceback.print_exc()
+                return None
+            return self.refreshed(token, redata)
+
+    @gen.coroutine
+    def refresh_async(self, stale):
+        """refresh() for code on the IOLoop - waits for the token's lock without blocking it."""
+        token = self.token(stale)
+        while not token.lock.acquire(False):
+            yield gen.Task(tornado.ioloop.IOLoop.current().add_timeout, time.time() + 0.05)
+        try:
+            if token.access_token != stale:
+                raise gen.Return((token.access_token, token.refresh_token))
+            if not token.refresh_token:
+                raise gen.Return(None)
+            try:
+                response = yield tornado.httpclient.AsyncHTTPClient().fetch(self.refresh_url(token))
+                redata = response.body
+            except tornado.httpclient.HTTPError, e:
+                redata = e.response.body if e.response else ""
+            raise gen.Return(self.refreshed(token, redata))
+        finally:
+            token.lock.release()
+
+    def refreshed(self, token, redata):
+        """Record a request_token response - called with the token's lock held."""
+        try:
+            mytoken = _parse_json(redata)
+        except ValueError:
+            mytoken = None
+        if not isinstance(mytoken, dict) or "error" in mytoken or "access_token" not in mytoken:
+            logging.warning("****** Access token refresh refused ******")
+            logging.warning(redata)
+            return None
+        token.access_token = mytoken["access_token"]
+        token.refresh_token = mytoken.get("refresh_token", token.refresh_token)
+        token.expires = time.time() + int(mytoken["expires_in"]) if mytoken.get("expires_in") else None
+        with self.lock:
+            self.tokens[token.access_token] = token
+        return token.access_token, token.refresh_token
+
+
+_token_manager = None
+
+
+def token_manager(options=None):
+    """Return the process-wide TokenManager, using the app's Geni credentials."""
+    global _token_manager
+    pool = connection_pool(options)
+    with _connection_pool_lock:
+        if _token_manager is None:
+            client_id = getattr(options, "historylink_id", None) or getattr(options, "geni_app_id", None)
+            client_secret = getattr(options, "historylink_secret", None) or getattr(options, "geni_app_secret", None)
+            margin = getattr(options, "geni_token_margin", None) or 300
+            _token_manager = TokenManager(client_id, client_secret, margin, pool)
+        return _token_manager
+
+
+BATCH_LIMITS = {
+    "history": (6, 1, 20),
+    "graph": (50, 5, 100),
+    "unions": (35, 5, 80),
+}
+
+
+class AdaptiveBatch(object):
+    """Number of ids to send in one multi-id lookup, tuned as calls complete.
+
+    A full batch answered quickly and cleanly grows the size by one id; a
+    response slower than latency seconds, larger than maxbytes or an error
+    halves it.  Access Denied only halves it once the denied share of recent
+    calls passes a half, as one user's private tree says little about the
+    batch size every user shares.  The size stays between minimum and maximum
+    and is also capped so the ids fit in maxurl characters of query string.
+    """
+
+    def __init__(self, size, minimum, maximum, latency=2.0, maxbytes=2 * 1024 * 1024, maxurl=1800):
+        self.size = float(size)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency = latency
+        self.maxbytes = maxbytes
+        self.maxurl = maxurl
+        self.idlength = 16.0
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.denials = 0
+        self.denied = 0.0
+
+    def current(self):
+        with self.lock:
+            fit = int(self.maxurl / self.idlength)
+            return int(max(self.minimum, min(self.size, self.maximum, fit)))
+
+    def chunks(self, ids):
+        n = self.current()
+        return [ids[i:i + n] for i in range(0, len(ids), n)]
+
+    def observe(self, ids, elapsed, nbytes, error=False, denied=False):
+        """Record one call to Geni for the list of ids."""
+        if not ids:
+            return
+        count = len(ids)
+        with self.lock:
+            self.calls += 1
+            self.idlength = 0.9 * self.idlength + 0.1 * sum(len(id) + 1 for id in ids) / count
+            # Decaying share of recent calls that were denied
+            self.denied = 0.9 * self.denied + (0.1 if denied else 0)
+            if denied:
+                self.denials += 1
+                if self.denied > 0.5:
+                    self.denied = 0.0
+                    self.size = max(self.minimum, min(self.size, count) / 2.0)
+            elif error or elapsed > self.latency or nbytes > self.maxbytes:
+                self.errors += 1 if error else 0
+                self.size = max(self.minimum, min(self.size, count) / 2.0)
+            elif count >= int(self.size) and elapsed < self.latency / 2:
+                self.size = min(self.maximum, self.size + 1)
+
+    def stats(self):
+        with self.lock:
+            return {"size": int(self.size), "calls": self.calls, "errors": self.errors, "denials": self.denials}
+
+
+_batch_controllers = {}
+
+
+def batch_controller(name, options=None):
+    """Return the process-wide AdaptiveBatch for name.  Bounds come from
+    options.geni_batch_limits, falling back to BATCH_LIMITS."""
+    with _connection_pool_lock:
+        if name not in _batch_controllers:
+            limits = getattr(options, "geni_batch_limits", None) or BATCH_LIMITS
+            size, minimum, maximum = limits.get(name) or BATCH_LIMITS[name]
+            latency = getattr(options, "geni_batch_latency", None) or 2.0
+            _batch_controllers[name] = AdaptiveBatch(size, minimum, maximum, latency)
+        return _batch_controllers[name]
+
+
+def transport_stats():
+    """stats() of the process-wide caches, breaker, scheduler and batch
+    controllers created so far, by name."""
+    with _connection_pool_lock:
+        parts = [("response cache", _response_cache), ("denied cache", _denied_cache),
+                 ("circuit breaker", _circuit_breaker), ("crawl scheduler", _crawl_scheduler)]
+        parts += [("batch " + name, _batch_controllers[name]) for name in sorted(_batch_controllers)]
+    return [(name, part.stats()) for name, part in parts if part is not None]
+
+
+def batch_denied(response):
+    return isinstance(response, dict) and isinstance(response.get("error"), dict) and \
+        response["error"].get("message") == "Access Denied"
+
+
+def batch_error(response):
+    """An empty or failed response, other than Access Denied - that says
+    something about the ids and the user, not about the batch size."""
+    return not response or (isinstance(response, dict) and "error" in response and not batch_denied(response))
+
+
+# Profile fields of a family group query when the caller does not narrow them
+FAMILY_FIELDS = "id,name,gender,master_profile,merge_pending,public,living,deleted,project_ids"
+
+
+def family_fields(master=False, merges=False, follow=False, project=False, problem=False, complete=False):
+    """The profile fields a family group crawl needs for its search options.
+
+    living is always requested - a Relative without it is marked Access
+    Denied - deleted lets Family skip deleted relatives, and public lets a
+    result be shared between users and cached.
+    """
+    fields = ["id", "name", "gender", "living", "deleted", "public"]
+    if master or complete:
+        fields.append("master_profile")
+    if merges or complete:
+        fields.append("merge_pending")
+    if project or problem:
+        fields.append("project_ids")
+    return ",".join(fields)
+
+
+def probe_fields(fields):
+    """fields with public added, which isolating denied profiles relies on."""
+    if "public" in fields.split(","):
+        return fields
+    return fields + ",public"
+
+
 class GeniAPI(object):
+    coalescer = _request_coalescer
 
     def __init__(self, access_token=None, refresh_token=None, options=None):
         self.access_token = access_token
         self.refresh_token = refresh_token
         self.options = options
+        self.pool = connection_pool(options)
+        self.limiter = rate_limiter(options)
+        self.cache = response_cache(options)
+        self.denied = denied_cache(options)
+        self.tokens = token_manager(options)
+        self.breaker = circuit_breaker(options)
 
     # based on: http://code.activestate.com/recipes/146306/
     def _encode_multipart_form(self, fields):
@@ -83,8 +1246,8 @@ class GeniAPI(object):
     def get_family(self, profile=None, siblings=True, parents=True, children=False, spouse=False):
         if not profile:
             profile = "profile"
-        elif not str(profile).startswith("profile"):
-            profile = "profile-" + profile
+        else:
+            profile = profile_key(profile)
         args = {"fields": "id,name,gender,deleted"}
         request = self.request(profile + "/immediate-family", args)
         family = Family(profile, request, siblings=siblings, parents=parents, children=children, spouse=spouse)
@@ -94,8 +1257,8 @@ class GeniAPI(object):
     def get_profile_detailed(self, profile=None):
         if not profile:
             profile = "profile"
-        elif not str(profile).startswith("profile"):
-            profile = "profile-" + profile
+        else:
+            profile = profile_key(profile)
         args = {
             "fields": "id,guid,name,title,first_name,middle_name,last_name,maiden_name,suffix,display_name,nicknames,gender,deleted,birth,baptism,death,burial,cause_of_death,is_alive,occupation,photo_urls,marriage,divorce,locked_fields,match_counts",
             "actions": "update,update-basics,add"}
@@ -106,18 +1269,18 @@ class GeniAPI(object):
             id = response["id"]
         if "name" in response:
             name = response["name"]
-        return Relative(id, name, "self", response)
+        return Relative(id, name, "self", response, raw=True)
 
     def get_family_detailed(self, profile=None, siblings=True, parents=True, children=False, spouse=False, focusprofile=False):
         if not profile:
             profile = "profile"
-        elif not str(profile).startswith("profile"):
-            profile = "profile-" + profile
+        else:
+            profile = profile_key(profile)
         args = {
             "fields": "id,guid,name,title,first_name,middle_name,last_name,maiden_name,suffix,display_name,nicknames,gender,deleted,birth,baptism,death,burial,cause_of_death,is_alive,occupation,photo_urls,marriage,divorce,locked_fields,match_counts",
             "actions": "update,update-basics,add"}
         request = self.request(profile + "/immediate-family", args)
-        family = Family(profile, request, siblings=siblings, parents=parents, children=children, spouse=spouse, focusprofile=focusprofile)
+        family = Family(profile, request, siblings=siblings, parents=parents, children=children, spouse=spouse, focusprofile=focusprofile, raw=True)
         #family.print_family()
         return family
 
@@ -133,7 +1296,7 @@ class GeniAPI(object):
         else:
             if "error" in family_group:
                 if "message" in family_group["error"]:
-                    if "Access Denied" == family_group["error"]["message"]:
+                    if family_group["error"]["message"] in ("Access Denied", "Geni unavailable"):
                         return family_list
                     elif "Invalid access token" == family_group["error"]["message"]:
                         return "Invalid access token"
@@ -141,68 +1304,171 @@ class GeniAPI(object):
             logging.warning(family_group)
         return family_list
 
-    def get_family_group(self, family_root, siblings=True, parents=True, children=False, spouse=False):
-        query = "profile/immediate-family"
-        ids = ""
-        result = []
+    def family_group_args(self, family_root, siblings=True, fields=None):
         if not isinstance(family_root, (list, tuple)):
             family_root = [family_root]
-        while len(family_root) > 0:
-            ids += family_root.pop() + ","
-        ids = ids[:-1]
+        ids = ",".join(profile_key(id) for id in reversed(family_root))
         extraargs = ""
         if not siblings:
             extraargs = ",claimed,birth,death"
-        args = {"ids": ids, "fields": "id,name,gender,master_profile,merge_pending,public,living,deleted,project_ids" + extraargs}
-        family_group = self.request(query, args)
-        if "error" not in family_group:
-            result = self.process_group(family_group, siblings=siblings, parents=parents, children=children, spouse=spouse)
-        else:
-            if "message" in family_group["error"]:
-                if "Invalid access token" == family_group["error"]["message"]:
-                    result = ["Invalid access token"]
-                elif "Access Denied" == family_group["error"]["message"]:
-                    newlist = []
-                    startlist = ids.split(",")
-                    if len(startlist) == 1:
-                        relative = self.get_profile(startlist[0])
-                        if "public" in relative:
-                            if not relative["public"]:
-                                return [Family("profile", relative, siblings=siblings, parents=parents, children=children, spouse=spouse, error="Access Denied")]
-                            else:
-                                return []
-                        else:
-                            return []
-                    idlist = [startlist[i::2] for i in range(2)]
-                    for family_root in idlist:
-                        newlist.extend(self.get_family_group(family_root, siblings=siblings, parents=parents, children=children, spouse=spouse))
-                    result = newlist
+        args = {"ids": ids, "fields": (fields or FAMILY_FIELDS) + extraargs}
+        return ids, args
+
+    def denied_family(self, relative, siblings=True, parents=True, children=False, spouse=False):
+        if "public" in relative:
+            if not relative["public"]:
+                return [Family("profile", relative, siblings=siblings, parents=parents, children=children, spouse=spouse, error="Access Denied")]
+        return []
+
+    def known_denied(self, ids, siblings=True, parents=True, children=False, spouse=False):
+        """Split ids into denied Families already in the negative cache and ids still to ask for."""
+        result = []
+        remaining = []
+        for id in ids.split(","):
+            relative = self.denied.get(self.access_token, id)
+            if relative is None:
+                remaining.append(id)
+            else:
+                result.extend(self.denied_family(relative, siblings=siblings, parents=parents, children=children, spouse=spouse))
+        return result, remaining
+
+    def public_ids(self, probe, ids):
+        """Split ids into the public ones and the rest, using a profile lookup."""
+        public = []
+        private = []
+        for id in ids:
+            item = probe.get(id.replace("profile-", ""))
+            if item and item.get("public"):
+                public.append(id)
+            else:
+                private.append(id)
+        return public, private
+
+    def probe_map(self, response):
+        if isinstance(response, dict) and "results" in response:
+            return dict((cache_id(item), item) for item in response["results"])
+        if isinstance(response, dict) and "id" in response:
+            return {cache_id(response): response}
+        return None
+
+    def family_message(self, family_group):
+        if isinstance(family_group, dict) and isinstance(family_group.get("error"), dict):
+            return family_group["error"].get("message", "")
+        return None
+
+    def get_family_group(self, family_root, siblings=True, parents=True, children=False, spouse=False, batch=None, fields=None):
+        query = "profile/immediate-family"
+        ids, args = self.family_group_args(family_root, siblings, fields)
+        result, remaining = self.known_denied(ids, siblings=siblings, parents=parents, children=children, spouse=spouse)
+        if not remaining:
+            return result
+        args["ids"] = ",".join(remaining)
+        family_group = self.cached_query(query, args, batch)
+        message = self.family_message(family_group)
+        if message is None:
+            return result + self.process_group(family_group, siblings=siblings, parents=parents, children=children, spouse=spouse)
+        if "Invalid access token" == message:
+            return ["Invalid access token"]
+        if "Access Denied" == message:
+            self.denied.count("refused")
+            groups = self.isolate_denied(remaining, args["fields"], siblings=siblings, parents=parents, children=children, spouse=spouse)
+            if isinstance(groups, str):
+                return [groups]
+            result.extend(groups)
+        return result
+
+    def isolate_denied(self, ids, fields, siblings=True, parents=True, children=False, spouse=False):
+        """Families for a batch of ids that Geni refused with Access Denied.
+
+        One profile lookup tells which ids are public.  Those are retried
+        together and only the rest are split in halves, skipping the query
+        for a half that must hold the denied profile.  Lone denied profiles
+        are built from the lookup instead of a get_profile call each.
+        """
+        probe = {}
+        if len(ids) > 1:
+            self.denied.count("probes")
+            probe = self.probe_map(self.cached_query("profile", {"ids": ",".join(ids), "fields": probe_fields(fields)})) or {}
+        public, private = self.public_ids(probe, ids) if probe else ([], ids)
+        result = []
+        refused = True
+        if public:
+            groups, refused = self.denied_group(public, probe, False, fields, siblings, parents, children, spouse)
+            if isinstance(groups, str):
+                return groups
+            result.extend(groups)
+            refused = not refused
+        if private:
+            groups = self.denied_group(private, probe, refused, fields, siblings, parents, children, spouse)[0]
+            if isinstance(groups, str):
+                return groups
+            result.extend(groups)
         return result
 
+    def retried_group(self, family_group, siblings, parents, children, spouse):
+        """Result of a retry during isolation: the Families, or None when it was refused."""
+        message = self.family_message(family_group)
+        if message is None:
+            return self.process_group(family_group, siblings=siblings, parents=parents, children=children, spouse=spouse)
+        if "Access Denied" != message:
+            return "Invalid access token" if "Invalid access token" == message else []
+        return None
+
+    def lone_denied(self, id, relative, siblings, parents, children, spouse):
+        if isinstance(relative, dict) and "public" in relative and not relative["public"]:
+            self.denied.put(self.access_token, id, relative)
+        return self.denied_family(relative, siblings=siblings, parents=parents, children=children, spouse=spouse)
+
+    def denied_group(self, ids, probe, refused, fields, siblings, parents, children, spouse):
+        """Families for ids, halving on Access Denied.  refused means the ids
+        are already known to hold a denied profile.  Returns the Families and
+        whether the ids were refused."""
+        if not refused:
+            self.denied.count("retries")
+            args = self.family_group_args(list(ids), siblings)[1]
+            args["fields"] = fields
+            groups = self.retried_group(self.cached_query("profile/immediate-family", args), siblings, parents, children, spouse)
+            if groups is not None:
+                return groups, False
+        if len(ids) == 1:
+            relative = probe.get(ids[0].replace("profile-", ""))
+            if relative is None:
+                self.denied.count("lookups")
+                relative = self.get_profile(ids[0])
+            return self.lone_denied(ids[0], relative, siblings, parents, children, spouse), True
+        half = len(ids) / 2
+        first, firstrefused = self.denied_group(ids[:half], probe, False, fields, siblings, parents, children, spouse)
+        if isinstance(first, str):
+            return first, True
+        second = self.denied_group(ids[half:], probe, not firstrefused, fields, siblings, parents, children, spouse)[0]
+        if isinstance(second, str):
+            return second, True
+        return first + second, True
+
     def get_parents(self, profile):
         family = self.get_family(profile, siblings=False)
         return family.get_parents()
 
-    def get_family_parents(self, profile):
-        family = self.get_direct_parents(profile)
+    def get_family_parents(self, profile, batch=None):
+        family = self.get_direct_parents(profile, batch)
         return family
 
-    def get_family_children(self, profile):
-        family = self.get_direct_children(profile)
+    def get_family_children(self, profile, batch=None):
+        family = self.get_direct_children(profile, batch)
         return family
 
-    def get_direct_parents(self, family_root):
-        unions = self.get_unions(family_root, siblings=False, parents=True, children=False, spouse=False)
+    def get_direct_parents(self, family_root, batch=None):
+        unions = self.get_unions(family_root, siblings=False, parents=True, children=False, spouse=False, batch=batch)
         return unions
 
-    def get_direct_children(self, family_root):
-        unions = self.get_unions(family_root, siblings=False, parents=False, children=True, spouse=False)
+    def get_direct_children(self, family_root, batch=None):
+        unions = self.get_unions(family_root, siblings=False, parents=False, children=True, spouse=False, batch=batch)
         return unions
 
-    def get_unions(self, family_root, siblings=True, parents=True, children=False, spouse=False):
+    def get_unions(self, family_root, siblings=True, parents=True, children=False, spouse=False, batch=None):
         fields = "id,union,living,deleted"
         query = "profile/immediate-family"
-        family_group = self.group_query(family_root, query, fields)
+        family_group = self.group_query(family_root, query, fields, batch)
         result = self.process_group(family_group, siblings=siblings, parents=parents, children=children, spouse=spouse)
         if isinstance(result, str):
             return result
@@ -216,7 +1482,7 @@ class GeniAPI(object):
         relative.update(results)
         return relative
 
-    def process_unions(self, family_group):
+    def relatives_by_id(self, family_group):
         allids = []
         allrelatives = {}
         for family in family_group:
@@ -226,35 +1492,79 @@ class GeniAPI(object):
                 else:
                     allrelatives[item.get_id()] = [item]
                     allids.append(item.get_id())
+        return allids, allrelatives
+
+    def update_relatives(self, union_results, allrelatives):
+        if "results" in union_results:
+            for item in union_results["results"]:
+                for relative in allrelatives[profile_id(item["id"])]:
+                    relative.update(item)
+        elif "name" in union_results:
+            item = union_results
+            for relative in allrelatives[profile_id(item["id"])]:
+                relative.update(item)
 
+    def process_unions(self, family_group):
+        allids, allrelatives = self.relatives_by_id(family_group)
         if len(allids) > 0:
             fields = "id,name,gender,master_profile,merge_pending,public,claimed,birth,death,living"
             query = "profile"
-            idchunks = self.chunks(allids, 35)
-            for idgroup in idchunks:
-                union_results = self.group_query(idgroup, query, fields)
-                if "results" in union_results:
-                    for item in union_results["results"]:
-                        for relative in allrelatives[item["id"]]:
-                            relative.update(item)
-                elif "name" in union_results:
-                    item = union_results
-                    for relative in allrelatives[item["id"]]:
-                        relative.update(item)
+            batch = batch_controller("unions", self.options)
+            while allids:
+                size = batch.current()
+                idgroup = allids[:size]
+                allids = allids[size:]
+                union_results = self.group_query(idgroup, query, fields, batch)
+                self.update_relatives(union_results, allrelatives)
             return family_group
         return []
 
-    def group_query(self, family_root, query, fields):
-        ids = ""
-        if isinstance(family_root, (list, tuple)):
-            while len(family_root) > 0:
-                ids += family_root.pop() + ","
-            ids = ids[:-1]
-        else:
-            ids = family_root
-        ids = ids.replace("profile-", "")
+    def group_query(self, family_root, query, fields, batch=None):
+        if not isinstance(family_root, (list, tuple)):
+            family_root = [family_root]
+        ids = ",".join(str(profile_id(id)) for id in reversed(family_root))
         args = {"ids": ids, "fields": fields, "only_ids": "true"}
-        return self.request(query, args)
+        return self.cached_query(query, args, batch)
+
+    def split_cached(self, query, args):
+        """Split the comma separated ids in args into results already in the
+        response cache and ids that still need a call to Geni."""
+        variant = self.cache.variant(args)
+        cached = []
+        missing = []
+        for id in args["ids"].split(","):
+            item = self.cache.get(query, id, variant, self.access_token)
+            if item is None:
+                missing.append(id)
+            else:
+                cached.append(item)
+        return variant, cached, missing
+
+    def merge_cached(self, query, variant, cached, response, count):
+        if response is None:
+            items = []
+        elif isinstance(response, dict) and "results" in response:
+            items = response["results"]
+        elif isinstance(response, dict) and ("id" in response or "focus" in response):
+            items = [response]
+        else:
+            return response
+        for item in items:
+            self.cache.put(query, cache_id(item), variant, item, self.access_token)
+        items = cached + items
+        if count == 1 and len(items) == 1:
+            return items[0]
+        return {"results": items}
+
+    def cached_query(self, query, args, batch=None):
+        """request() for a multi-id lookup that only asks Geni for the ids
+        missing from the response cache."""
+        variant, cached, missing = self.split_cached(query, args)
+        response = None
+        if missing:
+            args["ids"] = ",".join(missing)
+            response = self.request(query, args, batch=batch)
+        return self.merge_cached(query, variant, cached, response, len(cached) + len(missing))
 
     def get_children(self, profile):
         family = self.get_family(profile)
@@ -269,10 +1579,7 @@ class GeniAPI(object):
         return family.get_siblings()
 
     def get_master(self, profiles):
-        path = ""
-        for profile in profiles:
-            path += profile + ","
-        path = path[:-1]
+        path = ",".join(profile_key(profile) for profile in profiles)
         args = {"id": path, "fields": "id,name,master_profile"}
         result = self.request("profile", args)
         match = []
@@ -292,8 +1599,7 @@ class GeniAPI(object):
             project += "/" + path
         return self.request(project, args)
 
-    def get_projects(self, projects):
-        query = "project"
+    def cached_projects(self, projects):
         ids = ""
         resultlist = []
         if isinstance(projects, (list, tuple)):
@@ -311,27 +1617,35 @@ class GeniAPI(object):
                 resultlist.append({'id': idval, 'name': self.options.historycache[idval]})
             else:
                 ids = projects
+        return ids, resultlist
+
+    def cache_projects(self, results, resultlist):
+        if "results" in results:
+            results = results["results"]
+            for item in results:
+                idval = int(item["id"].replace("project-", ""))
+                self.options.historycache[idval] = item["name"]
+                resultlist.append({'id': idval, 'name': item["name"]})
+        else:
+            results["id"] = results["id"].replace("project-", "")
+            idval = int(results["id"].replace("project-", ""))
+            self.options.historycache[idval] = results["name"]
+            resultlist.append({'id': idval, 'name': results["name"]})
+        return resultlist
+
+    def get_projects(self, projects):
+        query = "project"
+        ids, resultlist = self.cached_projects(projects)
         if len(ids) > 0:
             ids = ids.replace("project-", "")
             fields = "id,name"
             args = {"ids": ids, "fields": fields}
             results = self.request(query, args)
-            if "results" in results:
-                results = results["results"]
-                for item in results:
-                    idval = int(item["id"].replace("project-", ""))
-                    self.options.historycache[idval] = item["name"]
-                    resultlist.append({'id': idval, 'name': item["name"]})
-            else:
-                results["id"] = results["id"].replace("project-", "")
-                idval = int(results["id"].replace("project-", ""))
-                self.options.historycache[idval] = results["name"]
-                resultlist.append({'id': idval, 'name': results["name"]})
+            resultlist = self.cache_projects(results, resultlist)
         return resultlist
 
     def get_profile(self, profile, path=None, args=None):
-        if not str(profile).startswith("profile"):
-            profile = "profile-" + profile
+        profile = profile_key(profile)
         if path:
             profile += "/" + path
         return self.request(profile, args)
@@ -356,9 +1670,12 @@ class GeniAPI(object):
         return info
 
     def get_project_profiles(self, project):
+        return list(self.iter_project_profiles(project))
+
+    def iter_project_profiles(self, project):
+        """Generator over a project's profiles that yields each page as it arrives."""
         args = {'fields': 'id,name'}
-        proj = Project(self, project, self.get_project(project, "profiles", args))
-        return proj.get_results()
+        return iter(Project(self, project, self.get_project(project, "profiles", args)))
 
     def get_project_collaborators(self, project):
         args = {'fields': 'id'}
@@ -372,119 +1689,193 @@ class GeniAPI(object):
 
     def follow_profile(self, profile):
         post_args = {'fields': 'id'}
-        return self.request(profile+"/follow", None, post_args)
+        return self.request(profile_key(profile) + "/follow", None, post_args)
 
     def unfollow_profile(self, profile):
         post_args = {'fields': 'id'}
-        return self.request(profile+"/unfollow", None, post_args)
+        return self.request(profile_key(profile) + "/unfollow", None, post_args)
 
     def chunks(self, l, n):
         return [l[i:i+n] for i in range(0, len(l), n)]
 
     def get_refresh_token(self):
+        """Refresh the access token through the TokenManager.  Returns True when
+        there is a new token to use."""
+        if not self.refresh_token:
+            return False
+        tokens = self.tokens.refresh(self.access_token)
+        if not tokens:
+            return False
+        self.access_token, self.refresh_token = tokens
+        return True
+
+    def sync_token(self):
+        """Pick up a token another client refreshed, or refresh one about to expire."""
         if self.refresh_token:
-            refresh = "https://www.geni.com/platform/oauth/request_token?" + urllib.urlencode({
-                "refresh_token": self.refresh_token,
-                "grant_type": "refresh_token",
-                "client_id": self.options.geni_app_id,
-                "client_secret": self.options.geni_app_secret,
-                })
-            response = urllib.urlopen(refresh)
-            redata = response.read()
-            if "error" in redata:
-                return
-            else:
-                mytoken = json.loads(redata)
-                self.access_token = mytoken["access_token"]
-                self.refresh_token = mytoken["refresh_token"]
+            self.access_token, self.refresh_token = self.tokens.current(self.access_token, self.refresh_token)
+
+    def request_url(self, url):
+        """Fetch a complete API url, such as a next_page link, through the shared
+        transport.  A failed call is retried once with a refreshed access token."""
+        for attempt in range(2):
+            self.limiter.acquire(self.access_token, is_interactive())
+            if not self.breaker.allow():
+                logging.warning("Geni unavailable (skipping): " + url)
+                return None
+            start = time.time()
+            try:
+                try:
+                    file = self.pool.urlopen(url)
+                except urllib2.HTTPError, e:
+                    self.breaker.record(e.code < 500, time.time() - start)
+                    raise
+                except:
+                    self.breaker.record(False)
+                    raise
+                self.breaker.record(True, time.time() - start)
+                self.limiter.update(self.access_token, file.info())
+                try:
+                    return _parse_json(file.read())
+                finally:
+                    file.close()
+            except:
+                if attempt:
+                    logging.warning("Problem getting (failed - skipping): " + url)
+                    traceback.print_exc()
+                    return None
+                logging.warning("Problem getting (trying again): " + url)
+                try:
+                    self.get_refresh_token()
+                except:
+                    traceback.print_exc()
+                if self.access_token:
+                    url = re.sub(r'access_token=[^&]*', 'access_token=' + self.access_token, url)
 
-    def request(self, path, args=None, post_args=None, post_data=None):
+    def request(self, path, args=None, post_args=None, post_data=None, batch=None):
         """Fetches the given path in the Geni API.
 
         We translate args to a valid query string. If post_args is given,
         we send a POST request to the given path with the given arguments.
+        Concurrent identical GETs share a single call to Geni.  Calls made
+        for a multi-id lookup are reported to its AdaptiveBatch.
         """
+        if post_args is not None or post_data:
+            return self.fetch(path, args, post_args, post_data)
+        key = self.coalescer.key(path, args)
+        for attempt in range(2):
+            flight, leader = self.coalescer.join(key, self.access_token)
+            if leader:
+                response = None
+                try:
+                    response = self.fetch(path, args, batch=batch)
+                finally:
+                    response = self.coalescer.finish(flight, response)
+                return response
+            response = self.coalescer.wait(flight, self.access_token)
+            if response is not None:
+                return response
+        return self.fetch(path, args, batch=batch)
+
+    def fetch(self, path, args=None, post_args=None, post_data=None, batch=None):
         args = args or {}
         response = ""
-        if self.access_token:
-            if post_args is not None:
-                post_args["access_token"] = self.access_token
-            else:
-                args["access_token"] = self.access_token
-        if not post_data and post_args:
-            post_data = urllib.urlencode(post_args)
-        try:
+        body = ""
+        form = post_data
+        refreshed = False
+        tries = 3 #Try it 3 times
+        while True:
+            self.sync_token()
+            if self.access_token:
+                if post_args is not None:
+                    post_args["access_token"] = self.access_token
+                else:
+                    args["access_token"] = self.access_token
+            if not form and post_args:
+                post_data = urllib.urlencode(post_args)
             url = "https://www.geni.com/api/" + path + "?" + urllib.urlencode(args)
-            if post_data and "file" in post_data:
-                opener = urllib2.build_opener(MultipartPostHandler.MultipartPostHandler)
-                file = opener.open(url, post_data)
-            else:
-                file = urllib2.urlopen(url, post_data)
-        except urllib2.HTTPError, e:
+            self.limiter.acquire(self.access_token, is_interactive())
+            if not self.breaker.allow():
+                return unavailable()
+            start = time.time()
             try:
-                response = _parse_json(e.read())
-            except:
-                response = sys.exc_info()[0]
-            if not isinstance(response, Iterable):
-                if post_data:
-                    logging.warning("****** Error with photo upload ******")
-                else:
-                    logging.warning("****** Error with Geni Response ******")
-                logging.warning(e.read())
-                if response:
-                    logging.info("****** Error: " + url + " ******")
-                    logging.warning(response)
-                #traceback.print_exc()
-                file = None
-            else:
                 try:
-                    if response and "error" in response and "message" in response["error"]:
-                        message = response["error"]["message"]
-                        if "Rate limit exceeded." == message:
-                            i = 3 #Try it 3 times
-                            while message == "Rate limit exceeded." and i > 0:
-                                time.sleep(3)
-                                i -= 1
-                                try:
-                                    file = urllib2.urlopen("https://www.geni.com/api/" + path + "?" +
-                                                           urllib.urlencode(args), post_data)
-                                    message = "Pass"
-                                except:
-                                    response = _parse_json(e.read())
-                                    if "error" in response and "message" in response["error"]:
-                                        message = response["error"]["message"]
-                                    else:
-                                        message = "error"
-                                        logging.warning("***** Error: " + path + "?" + urllib.urlencode(args) + " *****")
-                                        logging.warning(response)
-                                    file = None
-                        elif "Access Denied" == message:
-                            file = None
-                        else:
-                            logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
-                            logging.warning(response)
-                            file = None
+                    if post_data and "file" in post_data:
+                        opener = urllib2.build_opener(MultipartPostHandler.MultipartPostHandler)
+                        file = opener.open(url, post_data)
                     else:
-                        logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
-                        logging.warning("Problem with response - None")
-                        file = None
+                        file = self.pool.urlopen(url, post_data)
+                except urllib2.HTTPError, e:
+                    self.breaker.record(e.code < 500, time.time() - start)
+                    raise
                 except:
-                    try:
-                        logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                    self.breaker.record(False)
+                    raise
+                self.breaker.record(True, time.time() - start)
+                self.limiter.update(self.access_token, file.info())
+            except urllib2.HTTPError, e:
+                self.limiter.update(self.access_token, e.info())
+                try:
+                    body = e.read()
+                    response = _parse_json(body)
+                except:
+                    response = sys.exc_info()[0]
+                if not isinstance(response, Iterable):
+                    if post_data:
+                        logging.warning("****** Error with photo upload ******")
+                    else:
+                        logging.warning("****** Error with Geni Response ******")
+                    logging.warning(e.read())
+                    if response:
+                        logging.info("****** Error: " + url + " ******")
                         logging.warning(response)
-                        traceback.print_exc()
-                    except:
-                        logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
-                        logging.warning("Problem with response - Exception")
-                        traceback.print_exc()
+                    #traceback.print_exc()
                     file = None
+                else:
+                    try:
+                        if response and "error" in response and "message" in response["error"]:
+                            message = response["error"]["message"]
+                            if "Rate limit exceeded." == message:
+                                file = None
+                                if tries > 0:
+                                    tries -= 1
+                                    self.limiter.throttle(self.access_token)
+                                    continue
+                                logging.warning("***** Error: " + path + "?" + urllib.urlencode(args) + " *****")
+                                logging.warning(response)
+                            elif "Access Denied" == message:
+                                file = None
+                            elif "Invalid access token" == message and not refreshed and self.get_refresh_token():
+                                refreshed = True
+                                file = None
+                                continue
+                            else:
+                                logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                                logging.warning(response)
+                                file = None
+                        else:
+                            logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                            logging.warning("Problem with response - None")
+                            file = None
+                    except:
+                        try:
+                            logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                            logging.warning(response)
+                            traceback.print_exc()
+                        except:
+                            logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                            logging.warning("Problem with response - Exception")
+                            traceback.print_exc()
+                        file = None
+            break
         try:
             if file:
                 fileInfo = file.info()
                 if fileInfo.maintype == 'text':
-                    response = _parse_json(file.read())
+                    body = file.read()
+                    response = _parse_json(body)
                 elif fileInfo.maintype == 'application':
-                    response = _parse_json(file.read())
+                    body = file.read()
+                    response = _parse_json(body)
                 elif fileInfo.maintype == 'image':
                     mimetype = fileInfo['content-type']
                     response = {
@@ -501,74 +1892,364 @@ class GeniAPI(object):
         finally:
             if file:
                 file.close()
+        if batch and "ids" in args:
+            batch.observe(args["ids"].split(","), time.time() - start, len(body), batch_error(response),
+                          batch_denied(response))
         return response
 
 
+class AsyncGeniAPI(GeniAPI):
+    """Non-blocking sibling of GeniAPI for code running on the Tornado IOLoop.
+
+    request() and the batch lookups built on it return Futures instead of
+    results, so one process can keep many Geni calls in flight without a
+    thread for each.  Methods that only build arguments for request() (such as
+    get_profile and get_profile_info) are inherited and return its Future.
+    Only JSON endpoints are supported - uploads still need GeniAPI.
+    """
+
+    flights = {}
+
+    @gen.coroutine
+    def request(self, path, args=None, post_args=None, post_data=None, batch=None):
+        if post_args is not None or post_data:
+            response = yield self.fetch(path, args, post_args, post_data)
+            raise gen.Return(response)
+        key = self.coalescer.key(path, args)
+        if key in self.flights:
+            future, token = self.flights[key]
+            response = yield future
+            if token == self.access_token or is_shareable(response):
+                raise gen.Return(copy.deepcopy(response))
+            response = yield self.fetch(path, args, batch=batch)
+            raise gen.Return(response)
+        future = self.fetch(path, args, batch=batch)
+        self.flights[key] = (future, self.access_token)
+        try:
+            response = yield future
+        finally:
+            del self.flights[key]
+        raise gen.Return(copy.deepcopy(response))
+
+    @gen.coroutine
+    def fetch(self, path, args=None, post_args=None, post_data=None, batch=None):
+        args = args or {}
+        form = post_data
+        refreshed = False
+        client = tornado.httpclient.AsyncHTTPClient()
+        tries = 3 #Try it 3 times
+        while True:
+            yield self.sync_token_async()
+            if self.access_token:
+                if post_args is not None:
+                    post_args["access_token"] = self.access_token
+                else:
+                    args["access_token"] = self.access_token
+            if not form and post_args:
+                post_data = urllib.urlencode(post_args)
+            url = "https://www.geni.com/api/" + path + "?" + urllib.urlencode(args)
+            method = "POST" if post_data else "GET"
+            wait = self.limiter.reserve(self.access_token, True)
+            while wait > 0:
+                yield gen.Task(tornado.ioloop.IOLoop.current().add_timeout, time.time() + wait)
+                wait = self.limiter.reserve(self.access_token, True)
+            if not self.breaker.allow():
+                raise gen.Return(unavailable())
+            start = time.time()
+            try:
+                file = yield client.fetch(url, method=method, body=post_data)
+            except tornado.httpclient.HTTPError, e:
+                file = e.response
+            except:
+                self.breaker.record(False)
+                raise
+            self.breaker.record(file is not None and file.code < 500, time.time() - start)
+            if file:
+                self.limiter.update(self.access_token, file.headers)
+            response = ""
+            if file and file.body:
+                try:
+                    response = _parse_json(file.body)
+                except ValueError:
+                    logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                    logging.warning("Problem with response - Exception")
+            else:
+                logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                logging.warning("Problem with response - None")
+            message = None
+            if isinstance(response, dict) and isinstance(response.get("error"), dict):
+                message = response["error"].get("message")
+            if message == "Rate limit exceeded." and tries > 0:
+                tries -= 1
+                self.limiter.throttle(self.access_token)
+                continue
+            if message == "Invalid access token" and not refreshed:
+                refreshed = True
+                renewed = yield self.refresh_token_async()
+                if renewed:
+                    continue
+            if message and message != "Access Denied":
+                logging.warning("****** Error: " + path + "?" + urllib.urlencode(args) + " ******")
+                logging.warning(response)
+            if batch and "ids" in args:
+                size = len(file.body) if file and file.body else 0
+                batch.observe(args["ids"].split(","), time.time() - start, size, batch_error(response),
+                              batch_denied(response))
+            raise gen.Return(response)
+
+    @gen.coroutine
+    def refresh_token_async(self):
+        if not self.refresh_token:
+            raise gen.Return(False)
+        tokens = yield self.tokens.refresh_async(self.access_token)
+        if not tokens:
+            raise gen.Return(False)
+        self.access_token, self.refresh_token = tokens
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def sync_token_async(self):
+        if self.refresh_token:
+            token = self.tokens.token(self.access_token, self.refresh_token)
+            if self.tokens.due(token):
+                yield self.tokens.refresh_async(token.access_token)
+            self.access_token, self.refresh_token = token.access_token, token.refresh_token
+
+    @gen.coroutine
+    def cached_query(self, query, args, batch=None):
+        variant, cached, missing = self.split_cached(query, args)
+        response = None
+        if missing:
+            args["ids"] = ",".join(missing)
+            response = yield self.request(query, args, batch=batch)
+        raise gen.Return(self.merge_cached(query, variant, cached, response, len(cached) + len(missing)))
+
+    @gen.coroutine
+    def get_family_group(self, family_root, siblings=True, parents=True, children=False, spouse=False, batch=None, fields=None):
+        query = "profile/immediate-family"
+        ids, args = self.family_group_args(family_root, siblings, fields)
+        result, remaining = self.known_denied(ids, siblings=siblings, parents=parents, children=children, spouse=spouse)
+        if not remaining:
+            raise gen.Return(result)
+        args["ids"] = ",".join(remaining)
+        family_group = yield self.cached_query(query, args, batch)
+        message = self.family_message(family_group)
+        if message is None:
+            raise gen.Return(result + self.process_group(family_group, siblings=siblings, parents=parents, children=children, spouse=spouse))
+        if "Invalid access token" == message:
+            raise gen.Return(["Invalid access token"])
+        if "Access Denied" == message:
+            self.denied.count("refused")
+            groups = yield self.isolate_denied(remaining, args["fields"], siblings=siblings, parents=parents, children=children, spouse=spouse)
+            if isinstance(groups, str):
+                raise gen.Return([groups])
+            result.extend(groups)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def isolate_denied(self, ids, fields, siblings=True, parents=True, children=False, spouse=False):
+        probe = {}
+        if len(ids) > 1:
+            self.denied.count("probes")
+            response = yield self.cached_query("profile", {"ids": ",".join(ids), "fields": probe_fields(fields)})
+            probe = self.probe_map(response) or {}
+        public, private = self.public_ids(probe, ids) if probe else ([], ids)
+        result = []
+        refused = True
+        if public:
+            groups, refused = yield self.denied_group(public, probe, False, fields, siblings, parents, children, spouse)
+            if isinstance(groups, str):
+                raise gen.Return(groups)
+            result.extend(groups)
+            refused = not refused
+        if private:
+            groups = (yield self.denied_group(private, probe, refused, fields, siblings, parents, children, spouse))[0]
+            if isinstance(groups, str):
+                raise gen.Return(groups)
+            result.extend(groups)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def denied_group(self, ids, probe, refused, fields, siblings, parents, children, spouse):
+        if not refused:
+            self.denied.count("retries")
+            args = self.family_group_args(list(ids), siblings)[1]
+            args["fields"] = fields
+            family_group = yield self.cached_query("profile/immediate-family", args)
+            groups = self.retried_group(family_group, siblings, parents, children, spouse)
+            if groups is not None:
+                raise gen.Return((groups, False))
+        if len(ids) == 1:
+            relative = probe.get(ids[0].replace("profile-", ""))
+            if relative is None:
+                self.denied.count("lookups")
+                relative = yield self.get_profile(ids[0])
+            raise gen.Return((self.lone_denied(ids[0], relative, siblings, parents, children, spouse), True))
+        half = len(ids) / 2
+        first, firstrefused = yield self.denied_group(ids[:half], probe, False, fields, siblings, parents, children, spouse)
+        if isinstance(first, str):
+            raise gen.Return((first, True))
+        second = (yield self.denied_group(ids[half:], probe, not firstrefused, fields, siblings, parents, children, spouse))[0]
+        if isinstance(second, str):
+            raise gen.Return((second, True))
+        raise gen.Return((first + second, True))
+
+    @gen.coroutine
+    def get_unions(self, family_root, siblings=True, parents=True, children=False, spouse=False, batch=None):
+        fields = "id,union,living,deleted"
+        query = "profile/immediate-family"
+        family_group = yield self.group_query(family_root, query, fields, batch)
+        result = self.process_group(family_group, siblings=siblings, parents=parents, children=children, spouse=spouse)
+        if isinstance(result, str):
+            raise gen.Return(result)
+        result = yield self.process_unions(result)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def update_relative(self, relative):
+        fields = "id,name,gender,master_profile,merge_pending,public,claimed,birth,death,living"
+        query = "profile"
+        results = yield self.group_query(relative.get_id(), query, fields)
+        relative.update(results)
+        raise gen.Return(relative)
+
+    @gen.coroutine
+    def process_unions(self, family_group):
+        allids, allrelatives = self.relatives_by_id(family_group)
+        if len(allids) > 0:
+            fields = "id,name,gender,master_profile,merge_pending,public,claimed,birth,death,living"
+            query = "profile"
+            batch = batch_controller("unions", self.options)
+            union_results = yield [self.group_query(idgroup, query, fields, batch) for idgroup in batch.chunks(allids)]
+            for results in union_results:
+                self.update_relatives(results, allrelatives)
+            raise gen.Return(family_group)
+        raise gen.Return([])
+
+    @gen.coroutine
+    def get_projects(self, projects):
+        query = "project"
+        ids, resultlist = self.cached_projects(projects)
+        if len(ids) > 0:
+            ids = ids.replace("project-", "")
+            fields = "id,name"
+            args = {"ids": ids, "fields": fields}
+            results = yield self.request(query, args)
+            resultlist = self.cache_projects(results, resultlist)
+        raise gen.Return(resultlist)
+
+
 class Project(object):
-    def __init__(self, api, focus, response):
+    """Profiles of a project listing such as project-N/profiles.
+
+    Pages are fetched as they are consumed.  Once the first page shows the
+    total count and the page parameter of next_page, up to prefetch later
+    pages are downloaded concurrently through the shared transport.
+    """
+
+    def __init__(self, api, focus, response, prefetch=None):
         self.api = api
         self.focus = focus
         self.response = response
-        self.profiles = []
-        next = "start"
-        while next:
-            next = self.process_response()
+        self.prefetch = prefetch or getattr(api.options, "geni_page_prefetch", None) or 4
+        self.profiles = None
+
+    def __iter__(self):
+        return self.iter_profiles()
 
     def get_json(self):
         return self.response
 
     def get_results(self):
+        if self.profiles is None:
+            self.profiles = list(self.iter_profiles())
         return self.profiles
 
-    def process_response(self):
-        next = None
-        if not 'results' in self.response and "id" in self.response:
-            xitem = self.response
-            name = "(No Name)"
-            if "name" in xitem:
-                name = xitem["name"]
-            self.profiles.append({"id": xitem["id"], "name": name})
-            return next
-
-        for item in self.response:
-            if item == 'next_page':
-                try:
-                    next = self.response[item]
-                except:
-                    pass
-            if item == 'results':
-                for xitem in self.response[item]:
-                    try:
-                        name = "(No Name)"
-                        if "name" in xitem:
-                            name = xitem["name"]
-                        self.profiles.append({"id": xitem["id"], "name": name})
-                    except:
-                        pass
-
-        if next:
+    def iter_profiles(self):
+        """Yield {"id", "name"} for each profile, page by page."""
+        response = self.response
+        for profile in self.page_profiles(response):
+            yield profile
+        urls = self.page_urls(response)
+        if urls:
+            for response in self.prefetch_pages(urls):
+                for profile in self.page_profiles(response):
+                    yield profile
+            return
+        next = self.next_page(response)
+        while next:
+            response = self.api.request_url(next)
+            for profile in self.page_profiles(response):
+                yield profile
+            next = self.next_page(response)
+
+    def next_page(self, response):
+        if isinstance(response, dict):
+            return response.get("next_page")
+        return None
+
+    def page_profiles(self, response):
+        profiles = []
+        if not isinstance(response, dict):
+            return profiles
+        if not 'results' in response and "id" in response:
+            profiles.append({"id": response["id"], "name": response.get("name", "(No Name)")})
+            return profiles
+        for xitem in response.get("results", []):
             try:
-                file = urllib2.urlopen(next)
-                self.response = _parse_json(file.read())
+                name = "(No Name)"
+                if "name" in xitem:
+                    name = xitem["name"]
+                profiles.append({"id": xitem["id"], "name": name})
             except:
-                logging.warning("Problem getting (trying again): " + next)
-                try:
-                    self.api.get_refresh_token()
-                    next = re.sub(r'access_token.*?&', 'access_token=' + self.api.access_token + "&", next)
-                    file = urllib2.urlopen(next)
-                    self.response = _parse_json(file.read())
-                except:
-                    logging.warning("Problem getting (failed - skipping): " + next)
-                    traceback.print_exc()
-                    self.response = None
-                    next = None
-        return next
+                pass
+        return profiles
+
+    def page_urls(self, response):
+        """The urls of every remaining page, when they can be worked out from the first one."""
+        next = self.next_page(response)
+        if not next or not re.search(r'[?&]page=\d+', next):
+            return None
+        size = len(response.get("results", []))
+        total = response.get("total_count")
+        if not size or not total:
+            return None
+        pages = (int(total) + size - 1) / size
+        first = int(re.search(r'[?&]page=(\d+)', next).group(1))
+        return [re.sub(r'([?&])page=\d+', r'\g<1>page=%d' % page, next) for page in range(first, pages + 1)]
+
+    def prefetch_pages(self, urls):
+        """Yield the responses for urls in order, keeping up to prefetch of them downloading."""
+        urls = list(urls)
+        pending = []
+        while urls or pending:
+            while urls and len(pending) < self.prefetch:
+                fetch = PageFetch(self.api, urls.pop(0))
+                fetch.start()
+                pending.append(fetch)
+            fetch = pending.pop(0)
+            fetch.join()
+            yield fetch.response
+
+
+class PageFetch(threading.Thread):
+    def __init__(self, api, url):
+        super(PageFetch, self).__init__()
+        self.daemon = True
+        self.api = api
+        self.url = url
+        self.response = None
+
+    def run(self):
+        self.response = self.api.request_url(self.url)
 
 
 class Family(object):
-    def __init__(self, focus, response, siblings=True, parents=True, children=False, spouse=False, focusprofile=False, error=None):
+    def __init__(self, focus, response, siblings=True, parents=True, children=False, spouse=False, focusprofile=False, error=None, raw=False):
         self.unions = []
+        self.union_index = {}
         self.family = []
+        self.relative_index = {}
         self.person = None
         if error:
             profile = None
@@ -578,19 +2259,19 @@ class Family(object):
             if "name" in response:
                 name = response["name"]
             if profile:
-                relative = Relative(profile, name, "unknown", response, message=error)
+                relative = Relative(profile, name, "unknown", response, message=error, raw=raw)
                 if relative:
-                    self.family.append(relative)
+                    self.add_relative(relative)
             else:
                 logging.warning('No id? ' + response)
         else:
             if "profile" == focus:
                 if "name" in response["focus"] and "gender" in response["focus"]:
-                    self.person = Relative(response["focus"]["id"], response["focus"]["name"], self.self_relation(response["focus"]["gender"]), response["focus"])
+                    self.person = Relative(response["focus"]["id"], response["focus"]["name"], self.self_relation(response["focus"]["gender"]), response["focus"], raw=raw)
                 else:
-                    self.person = Relative(response["focus"]["id"], "Unknown", "father", response["focus"])
+                    self.person = Relative(response["focus"]["id"], "Unknown", "father", response["focus"], raw=raw)
             else:
-                self.person = Relative(focus, "Unknown", "father", response)
+                self.person = Relative(focus, "Unknown", "father", response, raw=raw)
             if not "nodes" in response:
                 return
             for item in response["nodes"]:
@@ -598,9 +2279,11 @@ class Family(object):
                     union = Union(str(item), response["nodes"][item])
                     if union:
                         self.unions.append(union)
+                        self.union_index[union.get_id()] = union
 
             for item in response["nodes"]:
                 if str(item).startswith("profile"):
+                    profile = profile_id(item)
                     deleted = None
                     if "deleted" in response["nodes"][item]:
                         deleted = response["nodes"][item]["deleted"]
@@ -616,19 +2299,24 @@ class Family(object):
                         name = response["nodes"][item]["name"]
                     for edge in response["nodes"][item]["edges"]:
                         rel = response["nodes"][item]["edges"][edge]["rel"]
-                        relative = self.process_unions(edge, item, rel, gender, name, response["nodes"][item])
+                        relative = self.process_unions(edge, profile, rel, gender, name, response["nodes"][item], raw)
                         if relative:
                             relation = relative.get_rel(0)
                             if focusprofile and relation == "focus":
-                                self.family.append(relative)
+                                self.add_relative(relative)
                             if parents and (relation == "parent" or relation == "mother" or relation == "father"):
-                                self.family.append(relative)
+                                self.add_relative(relative)
                             if siblings and (relation == "sibling" or relation == "brother" or relation == "sister"):
-                                self.family.append(relative)
+                                self.add_relative(relative)
                             if children and (relation == "child" or relation == "son" or relation == "daughter"):
-                                self.family.append(relative)
+                                self.add_relative(relative)
                             if spouse and (relation == "spouse" or relation == "wife" or relation == "husband" or relation == "partner"):
-                                self.family.append(relative)
+                                self.add_relative(relative)
+
+    def add_relative(self, relative):
+        self.family.append(relative)
+        if relative.get_id() not in self.relative_index:
+            self.relative_index[relative.get_id()] = relative
 
     def self_relation(self, gender="male"):
         if gender == "male":
@@ -656,10 +2344,7 @@ class Family(object):
         if "id" in profile:
             name = profile["name"]
             profile = profile["id"]
-        for item in self.family:
-            if item.get_id() == profile:
-                relative = item
-                break
+        relative = self.relative_index.get(profile_id(profile))
         if name:
             relative_profile = {"id": relative.get_id(), "relation": relative.get_rel(gen), "name": name}
         else:
@@ -778,27 +2463,63 @@ class Family(object):
         return relatives
 
     def print_family(self):
-        logging.info("\nFocus: " + self.person.get_id())
+        logging.info("\nFocus: %s" % self.person.get_key())
         for relative in self.family:
-            logging.info("\t" + relative.get_id() + ", " + relative.get_rel())
+            logging.info("\t%s, %s" % (relative.get_key(), relative.get_rel()))
         logging.info("\n")
 
-    def process_unions(self, union, profile, rel, gender, name, response):
-        for item in self.unions:
-            if union == item.get_id():
-                return item.get_edge(profile, self.person.get_id(), rel, gender, name, response)
+    def process_unions(self, union, profile, rel, gender, name, response, raw=False):
+        item = self.union_index.get(union)
+        if item:
+            return item.get_edge(profile, self.person.get_id(), rel, gender, name, response, raw)
+
+
+def lifespan_event(event):
+    """The parts of a birth or death event Relative.process_lifespan reads:
+    ((year, month, day, circa prefix), (city, state, country)), either part
+    None when the event has no date or location."""
+    if not isinstance(event, dict):
+        return None
+    date = event.get("date")
+    if isinstance(date, dict):
+        formatted = date.get("formatted_date", "")
+        circa = ""
+        if "before" in formatted:
+            circa = "bf."
+        elif "after" in formatted:
+            circa = "af."
+        elif "between" in formatted:
+            circa = "bt."
+        if "circa" in formatted:
+            circa += "c."
+        date = (date.get("year"), date.get("month"), date.get("day"), circa)
+    else:
+        date = None
+    location = event.get("location")
+    if isinstance(location, dict):
+        location = (location.get("city"), location.get("state"), location.get("country"))
+    else:
+        location = None
+    return date, location
 
 
 class Relative(object):
-    def __init__(self, id, name, relation, response, union="", status="", message=False, adopt=False):
+    __slots__ = ("relation", "name", "message", "adopted", "id", "union", "status", "response", "master", "public",
+                 "merge", "claimed", "living", "projects", "actions", "matches", "guid", "gender", "group",
+                 "blocation", "dlocation", "bcountry", "bstate", "dcountry", "dstate", "birth", "birthcirca",
+                 "death", "deathcirca", "lifespan")
+
+    def __init__(self, id, name, relation, response, union="", status="", message=False, adopt=False, raw=False):
         self.relation = relation
         self.name = name
         self.message = message
         self.adopted = adopt
-        self.id = id
+        self.id = profile_id(id) if id else id
         self.union = union
         self.status = status
-        self.response = response
+        # The raw Geni response is only needed by get_full_info and friends; holding it on every
+        # relative of a large graph costs more than all of the parsed fields together.
+        self.response = response if raw else None
         self.update(response)
 
     def update(self, response):
@@ -811,8 +2532,8 @@ class Relative(object):
         self.actions = []
         self.matches = {}
         self.guid = ""
-        birth = "yyyy-mm-dd"
-        death = "yyyy-mm-dd"
+        birth = None
+        death = None
         if response:
             if "actions" in response:
                 self.actions = response["actions"]
@@ -829,15 +2550,15 @@ class Relative(object):
             if "claimed" in response:
                 self.claimed = response["claimed"]
             if "birth" in response:
-                birth = response["birth"]
+                birth = lifespan_event(response["birth"])
             if "death" in response:
-                death = response["death"]
+                death = lifespan_event(response["death"])
             if "living" in response:
                 self.living = response["living"]
             else:
                 self.message = "Access Denied"
             if "id" in response:
-                self.id = response["id"]
+                self.id = profile_id(response["id"])
             if "name" in response:
                 self.name = response["name"]
             if "gender" in response:
@@ -848,146 +2569,107 @@ class Relative(object):
                 self.projects = [int(p.replace('project-', ' ')) for p in response["project_ids"]]
 
         self.group = ""
-        self.blocation = "Unknown"
-        self.dlocation = "Unknown"
-        self.bcountry = None
-        self.bstate = None
-        self.dcountry = None
-        self.dstate = None
-        self.birth = "yyyy-mm-dd"
-        self.birthcirca = ""
-        self.death = "yyyy-mm-dd"
-        self.deathcirca = ""
+        # Most relatives never have their dates shown, so the lifespan is parsed on first use.
+        # Only the parts of the events it reads are kept, not Geni's dicts.
+        self.lifespan = (birth, death)
+
+    def parse_lifespan(self):
+        if self.lifespan is None:
+            return
+        birth, death = self.lifespan
+        self.lifespan = None
         self.process_lifespan(birth, death)
 
     def process_lifespan(self, birth, death):
-        if birth:
-            day = "dd"
-            month = "mm"
-            year = "yyyy"
-            if "date" in birth:
-                if "year" in birth["date"]:
-                    year = str(birth["date"]["year"])
-                if "month" in birth["date"]:
-                    month = str(birth["date"]["month"]).zfill(2)
-                if "day" in birth["date"]:
-                    day = str(birth["date"]["day"]).zfill(2)
-                if "before" in birth["date"]["formatted_date"]:
-                    self.birthcirca = "bf."
-                elif "after" in birth["date"]["formatted_date"]:
-                    self.birthcirca = "af."
-                elif "between" in birth["date"]["formatted_date"]:
-                    self.birthcirca = "bt."
-                if "circa" in birth["date"]["formatted_date"]:
-                    self.birthcirca += "c."
-                self.birth = year + "-" + month + "-" + day
-            city = ""
-            country = ""
-            state = ""
-            if "location" in birth:
-                if "city" in birth["location"]:
-                    city = birth["location"]["city"]
-                    if "country" in birth["location"] or "state" in birth["location"]:
-                        city += ", "
-                if "state" in birth["location"]:
-                    state = birth["location"]["state"]
-                    self.bstate = state
-                    self.bcountry = state  #Covers pre-US States that have no country listed
-                    if "country" in birth["location"]:
-                        state += ", "
-                if "country" in birth["location"]:
-                    country = birth["location"]["country"]
-                    self.bcountry = country
-                self.blocation = city + state + country
-                if self.blocation.replace(",", "").strip() == "":
-                    self.blocation = "Unknown"
-                if self.blocation:
-                    self.blocation = self.blocation.replace('"', "'")
-                if self.bstate:
-                    self.bstate = self.bstate.replace('"', "'")
-                if self.bcountry:
-                    self.bcountry = self.bcountry.replace('"', "'")
-
-        if death:
-            day = "dd"
-            month = "mm"
-            year = "yyyy"
-            if "date" in death:
-                if "year" in death["date"]:
-                    year = str(death["date"]["year"])
-                if "month" in death["date"]:
-                    month = str(death["date"]["month"]).zfill(2)
-                if "day" in death["date"]:
-                    day = str(death["date"]["day"]).zfill(2)
-                if "before" in death["date"]["formatted_date"]:
-                    self.deathcirca = "bf."
-                elif "after" in death["date"]["formatted_date"]:
-                    self.deathcirca = "af."
-                elif "between" in death["date"]["formatted_date"]:
-                    self.deathcirca = "bt."
-                if "circa" in death["date"]["formatted_date"]:
-                    self.deathcirca += "c."
-                self.death = year + "-" + month + "-" + day
-            city = ""
-            country = ""
-            state = ""
-            if "location" in death:
-                if "city" in death["location"]:
-                    city = death["location"]["city"]
-                    if "country" in death["location"] or "state" in death["location"]:
-                        city += ", "
-                if "state" in death["location"]:
-                    state = death["location"]["state"]
-                    self.dstate = state
-                    self.dcountry = state  #Covers pre-US States that have no country listed
-                    if "country" in death["location"]:
-                        state += ", "
-                if "country" in death["location"]:
-                    country = death["location"]["country"]
-                    self.dcountry = country
-                self.dlocation = city + state + country
-                if self.dlocation.replace(",", "").strip() == "":
-                    self.dlocation = "Unknown"
-                if self.dlocation:
-                    self.dlocation = self.dlocation.replace('"', "'")
-                if self.dstate:
-                    self.dstate = self.dstate.replace('"', "'")
-                if self.dcountry:
-                    self.dcountry = self.dcountry.replace('"', "'")
+        self.birth, self.birthcirca, self.blocation, self.bstate, self.bcountry = self.process_event(birth)
+        self.death, self.deathcirca, self.dlocation, self.dstate, self.dcountry = self.process_event(death)
+
+    def process_event(self, event):
+        """Date, circa prefix, location, state and country of a lifespan_event tuple."""
+        when = "yyyy-mm-dd"
+        circa = ""
+        location = "Unknown"
+        state = None
+        country = None
+        if not event:
+            return when, circa, location, state, country
+        date, place = event
+        if date:
+            year, month, day, circa = date
+            when = (str(year) if year is not None else "yyyy") + "-" + \
+                   (str(month).zfill(2) if month is not None else "mm") + "-" + \
+                   (str(day).zfill(2) if day is not None else "dd")
+        if place:
+            city, state, country = place
+            location = ""
+            if city is not None:
+                location = city
+                if country is not None or state is not None:
+                    location += ", "
+            if state is not None:
+                location += state
+                if country is not None:
+                    location += ", "
+            if country is not None:
+                location += country
+            elif state is not None:
+                country = state  #Covers pre-US States that have no country listed
+            if location.replace(",", "").strip() == "":
+                location = "Unknown"
+            if location:
+                location = location.replace('"', "'")
+            if state:
+                state = state.replace('"', "'")
+            if country:
+                country = country.replace('"', "'")
+        return when, circa, location, state, country
 
     def get_birth_location(self):
+        self.parse_lifespan()
         return self.blocation
 
     def get_birth_country(self):
+        self.parse_lifespan()
         return self.bcountry
 
     def get_birth_state(self):
+        self.parse_lifespan()
         return self.bstate
 
     def get_birth_date(self):
+        self.parse_lifespan()
         return self.birth
 
     def get_birth_circa(self):
+        self.parse_lifespan()
         return self.birthcirca
 
     def get_death_location(self):
+        self.parse_lifespan()
         return self.dlocation
 
     def get_death_country(self):
+        self.parse_lifespan()
         return self.dcountry
 
     def get_death_state(self):
+        self.parse_lifespan()
         return self.dstate
 
     def get_death_date(self):
+        self.parse_lifespan()
         return self.death
 
     def get_death_circa(self):
+        self.parse_lifespan()
         return self.deathcirca
 
     def get_id(self):
         return self.id
 
+    def get_key(self):
+        return profile_key(self.id)
+
     def get_name(self):
         return self.name
 
@@ -1046,11 +2728,11 @@ class Relative(object):
         return self.guid
 
     def get_info(self):
-        return {"name": self.get_name(), "id": self.get_id(), "relation": self.get_rel(), "union": self.get_union()}
+        return {"name": self.get_name(), "id": self.get_key(), "relation": self.get_rel(), "union": self.get_union()}
 
     def get_date(self, event):
         eventstr = ""
-        if event in self.response and "date" in self.response[event]:
+        if self.response and event in self.response and "date" in self.response[event]:
             startstr = []
             evttime = self.response[event]["date"]
             if "circa" in evttime:
@@ -1081,7 +2763,7 @@ class Relative(object):
 
     def get_location(self, event):
         eventstr = ""
-        if event in self.response:
+        if self.response and event in self.response:
             evttime = self.response[event]
             location = []
             if "location" in evttime:
@@ -1099,6 +2781,8 @@ class Relative(object):
         return eventstr
 
     def get_full_info(self, adopt=None):
+        if self.response is None:
+            self.response = {"id": self.id, "name": self.name}
         birth = self.get_date("birth")
         death = self.get_date("death")
         baptism = self.get_date("baptism")
@@ -1197,9 +2881,12 @@ class Relative(object):
 
 
 class Union(object):
+    __slots__ = ("id", "edges", "edge_index", "status", "marriage", "divorce")
+
     def __init__(self, id, response):
         self.id = id
         self.edges = []
+        self.edge_index = {}
         self.status = ""
         self.marriage = None
         self.divorce = None
@@ -1210,9 +2897,10 @@ class Union(object):
                 adopt = False
                 if "rel_modifier" in response["edges"][item]:
                     adopt = True
-                edge = Edge(item, response["edges"][item]["rel"], self.id, adopt)
+                edge = Edge(profile_id(item), response["edges"][item]["rel"], self.id, adopt)
                 if edge:
                     self.edges.append(edge)
+                    self.edge_index.setdefault(edge.get_profile(), edge)
         if "marriage" in response:
             self.marriage = response["marriage"]
         if "divorce" in response:
@@ -1221,7 +2909,7 @@ class Union(object):
     def print_union(self):
         logging.info(self.id + " (" + self.status + ")")
         for edge in self.edges:
-            logging.info("\t" + edge.profile + " (" + edge.rel + ")")
+            logging.info("\t%s (%s)" % (profile_key(edge.profile), edge.rel))
 
     def get_type(self, rel):
         for x in self.edges:
@@ -1246,46 +2934,49 @@ class Union(object):
             response["divorce"] = self.divorce
         return response
 
-    def get_edge(self, profile, focus, rel, gender, name, response):
-        for x in self.edges:
-            if focus == x.get_profile():
-                rel2 = x.get_rel()
-                if profile == focus:
-                    return Relative(profile, name, "focus", response, self.id, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "child" and gender == "male":
-                    return Relative(profile, name, "father", self.details(response), self.id, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "child" and gender == "female":
-                    return Relative(profile, name, "mother", self.details(response), self.id, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "child":
-                    return Relative(profile, name, "parent", self.details(response), self.id, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "partner" and gender == "male" and (self.status == "spouse" or self.status == "ex_spouse"):
-                    return Relative(profile, name, "husband", self.details(response), self.id, status=self.status, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "partner" and gender == "female" and (self.status == "spouse" or self.status == "ex_spouse"):
-                    return Relative(profile, name, "wife", self.details(response), self.id, status=self.status, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "partner" and (self.status == "spouse" or self.status == "ex_spouse"):
-                    return Relative(profile, name, "spouse", self.details(response), self.id, status=self.status, adopt=x.is_adopted())
-                elif rel == "partner" and rel2 == "partner" and self.status == "partner":
-                    return Relative(profile, name, "partner", response, self.id, status=self.status, adopt=x.is_adopted())
-                elif rel == "child" and rel2 == "partner" and gender == "male":
-                    return Relative(profile, name, "son", response, self.id, adopt=x.is_adopted())
-                elif rel == "child" and rel2 == "partner" and gender == "female":
-                    return Relative(profile, name, "daughter", response, self.id, adopt=x.is_adopted())
-                elif rel == "child" and rel2 == "partner":
-                    return Relative(profile, name, "child", response, self.id, adopt=x.is_adopted())
-                elif rel == "child" and rel2 == "child" and gender == "male":
-                    return Relative(profile, name, "brother", response, self.id, adopt=x.is_adopted())
-                elif rel == "child" and rel2 == "child" and gender == "female":
-                    return Relative(profile, name, "sister", response, self.id, adopt=x.is_adopted())
-                elif rel == "child" and rel2 == "child":
-                    return Relative(profile, name, "sibling", response, self.id, adopt=x.is_adopted())
-                else:
-                    return None
+    def get_edge(self, profile, focus, rel, gender, name, response, raw=False):
+        x = self.edge_index.get(focus)
+        if not x:
+            return None
+        rel2 = x.get_rel()
+        if profile == focus:
+            return Relative(profile, name, "focus", response, self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "child" and gender == "male":
+            return Relative(profile, name, "father", self.details(response), self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "child" and gender == "female":
+            return Relative(profile, name, "mother", self.details(response), self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "child":
+            return Relative(profile, name, "parent", self.details(response), self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "partner" and gender == "male" and (self.status == "spouse" or self.status == "ex_spouse"):
+            return Relative(profile, name, "husband", self.details(response), self.id, status=self.status, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "partner" and gender == "female" and (self.status == "spouse" or self.status == "ex_spouse"):
+            return Relative(profile, name, "wife", self.details(response), self.id, status=self.status, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "partner" and (self.status == "spouse" or self.status == "ex_spouse"):
+            return Relative(profile, name, "spouse", self.details(response), self.id, status=self.status, adopt=x.is_adopted(), raw=raw)
+        elif rel == "partner" and rel2 == "partner" and self.status == "partner":
+            return Relative(profile, name, "partner", response, self.id, status=self.status, adopt=x.is_adopted(), raw=raw)
+        elif rel == "child" and rel2 == "partner" and gender == "male":
+            return Relative(profile, name, "son", response, self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "child" and rel2 == "partner" and gender == "female":
+            return Relative(profile, name, "daughter", response, self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "child" and rel2 == "partner":
+            return Relative(profile, name, "child", response, self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "child" and rel2 == "child" and gender == "male":
+            return Relative(profile, name, "brother", response, self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "child" and rel2 == "child" and gender == "female":
+            return Relative(profile, name, "sister", response, self.id, adopt=x.is_adopted(), raw=raw)
+        elif rel == "child" and rel2 == "child":
+            return Relative(profile, name, "sibling", response, self.id, adopt=x.is_adopted(), raw=raw)
+        else:
+            return None
 
     def get_id(self):
         return self.id
 
 
 class Edge(object):
+    __slots__ = ("profile", "rel", "union", "adopt")
+
     def __init__(self, profile, rel, union, adopt=False):
         self.profile = profile
         self.rel = rel
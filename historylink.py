@@ -39,6 +39,7 @@ from tree import Tree
 import time
 
 import geni
+import sessionstore
 
 # Find a JSON parser
 try:
@@ -69,10 +70,50 @@ define("historyprofiles", type=set)
 define("historycache", type=dict)
 define("countrycodes", type=dict)
 define("statecodes", type=dict)
+define("geni_pool_size", type=int, default=30)
+define("geni_max_clients", type=int, default=200)
+define("geni_rate_limit", type=float, default=4.0)
+define("geni_rate_burst", type=int, default=40)
+define("geni_priority_share", type=float, default=0.5)
+define("geni_cache_mb", type=int, default=32)
+define("geni_cache_path")
+define("geni_cache_disk_mb", type=int, default=256)
+define("geni_batch_limits", type=dict)
+define("geni_batch_latency", type=float, default=2.0)
+define("geni_denied_ttl", type=int, default=3600)
+define("geni_page_prefetch", type=int, default=4)
+define("geni_client_idle", type=int, default=900)
+define("geni_token_margin", type=int, default=300)
+define("validate_ttl", type=int, default=300)
+define("geni_breaker_threshold", type=int, default=10)
+define("geni_breaker_window", type=int, default=20)
+define("geni_breaker_slow", type=float, default=30.0)
+define("geni_breaker_cooldown", type=float, default=30.0)
+define("geni_slots", type=int, default=30)
+define("geni_user_slots", type=int, default=15)
+define("geni_scheduler_quantum", type=int, default=20)
+define("session_ttl", type=int, default=3600)
+define("session_budget_mb", type=int, default=128)
+define("session_sweep", type=int, default=60)
+define("session_store")
+define("session_flush", type=float, default=0.5)
 
 #class GeniApplication(tornado.wsgi.WSGIApplication):
 class GeniApplication(tornado.web.Application):
+    def sweep_sessions(self):
+        """Evict idle sessions every session_sweep seconds, on a thread of its
+        own so measuring them never holds up the IOLoop."""
+        while True:
+            time.sleep(options.session_sweep)
+            try:
+                evicted = self.linkHolder.evict(options.session_ttl, options.session_budget_mb * 1024 * 1024)
+                if evicted:
+                    logging.info("Evicted %d idle sessions" % len(evicted))
+            except Exception:
+                logging.exception("Session sweep failed")
+
     def __init__(self):
+        LinkHolder.store = sessionstore.create_store(options)
         self.linkHolder = LinkHolder()
         base_dir = os.path.dirname(__file__)
         canvas_id = options.historylink_canvas_id
@@ -119,6 +160,7 @@ class GeniApplication(tornado.web.Application):
             tornado.web.url(r"/login", LoginHandler, name="login"),
             tornado.web.url(r"/logout", LogoutHandler, name="logout"),
             tornado.web.url(r"/geni", GeniCanvasHandler),
+            tornado.web.url(r"/sessions", SessionsHandler),
         ], **settings)
 
 
@@ -152,35 +194,68 @@ tornado.web.ErrorHandler = ErrorHandler
 
 
 class LinkHolder(object):
-    cookie = {}
+    """Per-user state of history searches and graphs.
 
-    def set(self, id, key, value):
+    What the pollers read (counters, stage, matches, per-generation counts,
+    graph JSON) goes through store, which may be shared between processes.
+    cookie only holds the working state of a search running in this process:
+    the profiles queued per generation, parent matches and the match indexes.
+    """
+    cookie = {}
+    store = sessionstore.MemoryStore()
+    unique_messages = ("Master Profile", "Non-Master Public", "Parent Conflict", "Merge Pending")
+    # A user's state is guarded by one of a fixed set of locks picked by the
+    # user id, so the SubWorkers of different users don't wait on each other
+    locks = [threading.RLock() for i in range(16)]
+    # Last time each user's state was read or written, for idle eviction
+    touched = {}
+    # Each user's measured size and when it was measured
+    sizes = {}
+    defaults = {"count": 0, "mpcount": 0, "pending": 0, "problems": 0, "pconflict": 0, "stage": "parent's family",
+                "running": 0, "graphrunning": 0, "hits": 0}
+
+    def lock(self, id):
+        return self.locks[hash(id) % len(self.locks)]
+
+    def touch(self, id):
+        self.touched[id] = time.time()
+
+    def local(self, id):
         if not id in self.cookie:
             self.cookie[id] = {}
-        self.cookie[id][key] = value
+        return self.cookie[id]
+
+    def set(self, id, key, value):
+        self.touch(id)
+        with self.lock(id):
+            self.store.set(id, key, value)
 
     def clear_matches(self, id):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        self.cookie[id]["matches"] = []
-        self.cookie[id]["parentmatches"] = {}
-        self.cookie[id]["gencount"] = {}
-        self.cookie[id]["history"] = set([])
-        self.cookie[id]["familyroot"] = []
+        self.touch(id)
+        with self.lock(id):
+            local = self.local(id)
+            local["matchindex"] = {}
+            local["matchkeys"] = set([])
+            local["parentmatches"] = {}
+            local["history"] = {}
+            self.store.clear(id, ("matches", "gencount"))
 
     def add_matches(self, id, profile):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "matches" in self.cookie[id]:
-            self.cookie[id]["matches"] = []
-        exists = None
-        if "hits" in self.cookie[id]:
-            self.cookie[id]["hits"] += 1
-        else:
-            self.cookie[id]["hits"] = 1
-        message = None
-        for items in self.cookie[id]["matches"]:
-            if items["id"] == profile["id"]:
+        self.touch(id)
+        with self.lock(id):
+            local = self.local(id)
+            if not "matchindex" in local:
+                local["matchindex"] = {}
+                local["matchkeys"] = set([])
+            self.store.add(id, {"hits": 1})
+            # Positions and entries of the matches already stored for this profile,
+            # and the (profile, message) pairs that are only ever listed once
+            index = local["matchindex"]
+            keys = local["matchkeys"]
+            key = (profile["id"], profile["message"])
+            message = profile["message"] in self.unique_messages and key in keys
+            exists = None
+            for position, items in index.get(profile["id"], []):
                 #Give more weight to parents over aunts/uncles
                 exists = True
                 if "aunt" in profile["relation"]:
@@ -191,41 +266,34 @@ class LinkHolder(object):
                     pass
                 elif "father" in items["relation"]:
                     pass
-                else:
+                elif items["relation"] != profile["relation"]:
                     items["relation"] = profile["relation"]
-
-                if profile["message"] == "Master Profile" and items["message"] == "Master Profile":
-                    message = True
-                    break
-                elif profile["message"] == "Non-Master Public" and items["message"] == "Non-Master Public":
-                    message = True
+                    self.store.replace(id, "matches", position, items)
+                if message and items["message"] == profile["message"]:
                     break
-                elif profile["message"] == "Parent Conflict" and items["message"] == "Parent Conflict":
-                    message = True
-                    break
-                elif profile["message"] == "Merge Pending" and items["message"] == "Merge Pending":
-                    message = True
-                    break
-
-        if not exists:
-            self.cookie[id]["matches"].append(profile)
-        elif profile["message"] and not message:
-            self.cookie[id]["matches"].append(profile)
-            exists = False
 
-        return exists
-
-    def add_parentmatch(self, id, gen, profile):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "parentmatches" in self.cookie[id]:
-            self.cookie[id]["parentmatches"] = {}
-        if not gen in self.cookie[id]["parentmatches"]:
-            self.cookie[id]["parentmatches"][gen] = {}
-        if not profile in self.cookie[id]["parentmatches"][gen]:
-            self.cookie[id]["parentmatches"][gen][profile] = 1
-        else:
-            self.cookie[id]["parentmatches"][gen][profile] += 1
+            if not exists or (profile["message"] and not message):
+                position = self.store.append(id, "matches", profile) - 1
+                index.setdefault(profile["id"], []).append((position, profile))
+                if profile["message"] in self.unique_messages:
+                    keys.add(key)
+                if exists:
+                    exists = False
+
+            return exists
+
+    def add_parentmatch(self, id, gen, profile, count=1):
+        self.touch(id)
+        with self.lock(id):
+            local = self.local(id)
+            if not "parentmatches" in local:
+                local["parentmatches"] = {}
+            if not gen in local["parentmatches"]:
+                local["parentmatches"][gen] = {}
+            if not profile in local["parentmatches"][gen]:
+                local["parentmatches"][gen][profile] = count
+            else:
+                local["parentmatches"][gen][profile] += count
 
     def get_parentmatch(self, id, gen, profile):
         if not id in self.cookie:
@@ -239,130 +307,90 @@ class LinkHolder(object):
         return self.cookie[id]["parentmatches"][gen][profile]
 
     def remove_parentmatch(self, id, gen):
-        if not id in self.cookie:
-            return
-        if not "parentmatches" in self.cookie[id]:
-            return
-        if not gen in self.cookie[id]["parentmatches"]:
+        with self.lock(id):
+            if not id in self.cookie:
+                return
+            if not "parentmatches" in self.cookie[id]:
+                return
+            if not gen in self.cookie[id]["parentmatches"]:
+                return
+            else:
+                self.cookie[id]["parentmatches"][gen] = {}
             return
-        else:
-            self.cookie[id]["parentmatches"][gen] = {}
-        return
 
     def get_matches(self, id):
-        if not id in self.cookie:
-            return []
-        if not "matches" in self.cookie[id]:
-            return []
-        return self.cookie[id]["matches"]
+        self.touch(id)
+        return self.store.items(id, "matches")
 
     def get_matchcount(self, id):
-        if not id in self.cookie:
-            return 0
-        if not "matches" in self.cookie[id]:
-            return 0
-        return len(self.cookie[id]["matches"])
+        return self.store.length(id, "matches")
 
     def addParentCount(self, id, gen, parentcount, mastercount):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "gencount" in self.cookie[id]:
-            self.cookie[id]["gencount"] = {}
-        if not str(gen) in self.cookie[id]["gencount"]:
-            self.cookie[id]["gencount"][str(gen)] = {}
-            self.cookie[id]["gencount"][str(gen)]["count"] = parentcount
-            self.cookie[id]["gencount"][str(gen)]["mpcount"] = mastercount
-            self.cookie[id]["gencount"][str(gen)]["label"] = str(self.getGeneration(gen)) + "s"
-        else:
-            self.cookie[id]["gencount"][str(gen)]["count"] += parentcount
-            self.cookie[id]["gencount"][str(gen)]["mpcount"] += mastercount
+        self.touch(id)
+        with self.lock(id):
+            self.store.add_field(id, "gencount", "%d:count" % gen, parentcount)
+            self.store.add_field(id, "gencount", "%d:mpcount" % gen, mastercount)
+            self.store.set_field(id, "gencount", "%d:label" % gen, str(self.getGeneration(gen)) + "s")
 
     def getParentCount(self, id):
-        if not id in self.cookie:
-            return None
-        if not "gencount" in self.cookie[id]:
+        fields = self.store.fields(id, "gencount")
+        if not fields:
             return None
-        return self.cookie[id]["gencount"]
-
-    def set_familyroot(self, id, root):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        self.cookie[id]["familyroot"] = root
-
-    def append_familyroot(self, id, profile):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "familyroot" in self.cookie[id]:
-            self.cookie[id]["familyroot"] = []
-        if not profile in self.cookie[id]["familyroot"]:
-            self.cookie[id]["familyroot"].append(profile)
-
-    def get_familyroot(self, id):
-        if not id in self.cookie:
-            return []
-        if not "familyroot" in self.cookie[id]:
-            return []
-        return self.cookie[id]["familyroot"]
-
-    def add_history(self, id, history):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "history" in self.cookie[id]:
-            self.cookie[id]["history"] = set(history)
-        else:
-            self.cookie[id]["history"].update(history)
-
-    def get_history(self, id):
-        if not id in self.cookie:
-            return set([])
-        if not "history" in self.cookie[id]:
-            return set([])
-        return self.cookie[id]["history"]
+        gencount = {}
+        for field in fields:
+            gen, name = field.split(":")
+            if not gen in gencount:
+                gencount[gen] = {}
+            gencount[gen][name] = fields[field]
+        return gencount
+
+    def add_history(self, id, gen, profile):
+        """Record profile as queued at generation gen.  False when it already was."""
+        self.touch(id)
+        with self.lock(id):
+            local = self.local(id)
+            if not "history" in local:
+                local["history"] = {}
+            if not gen in local["history"]:
+                local["history"][gen] = set([])
+            if profile in local["history"][gen]:
+                return False
+            local["history"][gen].add(profile)
+            return True
 
     def reset_matchhit(self, id):
-        if not id in self.cookie:
-            return
-            #if "matches" in self.cookie[id]:
-            #self.cookie[id]["matches"] = []
-        if "hits" in self.cookie[id]:
-            self.cookie[id]["hits"] = 0
-        return
+        with self.lock(id):
+            self.store.set(id, "hits", 0)
 
     def reset(self, id):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        self.cookie[id]["hits"] = 0
-        self.cookie[id]["count"] = 0
-        self.cookie[id]["mpcount"] = 0
-        self.cookie[id]["pending"] = 0
-        self.cookie[id]["pconflict"] = 0
-        self.cookie[id]["stage"] = "parent's family"
-        self.clear_matches(id)
+        with self.lock(id):
+            self.store.update(id, {"hits": 0, "count": 0, "mpcount": 0, "pending": 0, "pconflict": 0,
+                                   "stage": "parent's family", "unavailable": None})
+            self.clear_matches(id)
 
     def get(self, id, key):
-        if id in self.cookie:
-            if key in self.cookie[id]:
-                return self.cookie[id][key]
-        if key == "count":
-            return 0
-        elif key == "mpcount":
-            return 0
-        elif key == "pending":
-            return 0
-        elif key == "problems":
-            return 0
-        elif key == "pconflict":
-            return 0
-        elif key == "stage":
-            return "parent's family"
-        elif key == "running":
-            return 0
-        elif key == "graphrunning":
-            return 0
-        elif key == "hits":
-            return 0
-        else:
-            return None
+        self.touch(id)
+        value = self.store.get(id, key)
+        if value is None:
+            return self.defaults.get(key)
+        return value
+
+    def snapshot(self, id, keys):
+        """Several values for a poller in one store round trip, with the same defaults as get."""
+        self.touch(id)
+        values = self.store.snapshot(id, keys)
+        for key in keys:
+            if values[key] is None:
+                values[key] = self.defaults.get(key)
+        return values
+
+    def increment(self, id, key, value=1):
+        self.add_counts(id, {key: value})
+
+    def add_counts(self, id, counts):
+        self.touch(id)
+        with self.lock(id):
+            self.store.add(id, counts)
 
     def getGeneration(self, gen):
         stage = "parent"
@@ -397,18 +425,88 @@ class LinkHolder(object):
         return value
 
     def stop(self, id):
-        if id and id in self.cookie:
-            if "running" in self.cookie[id]:
-                self.cookie[id]["running"] = 0
-            self.reset(id)
+        with self.lock(id):
+            if id:
+                self.store.set(id, "running", 0)
+                self.reset(id)
+
+    def halt(self, id, reason):
+        """Stop a crawl and flag why, keeping its counts and matches on show."""
+        with self.lock(id):
+            if id:
+                self.store.update(id, {"running": 0, reason: True})
+
+    def is_running(self, id):
+        values = self.store.snapshot(id, ("running", "graphrunning"))
+        return values["running"] == 1 or values["graphrunning"] == 1
+
+    def session_size(self, id):
+        """Approximate bytes held in this process for a user: matches, history, graph JSON, uploaded SVG.
+        Only users touched since they were last measured are measured again."""
+        size = self.sizes.get(id)
+        if size is None or size[1] <= self.touched.get(id, 0):
+            measured = time.time()
+            with self.lock(id):
+                size = (sessionstore.deep_size(self.cookie.get(id, {})) + self.store.size(id), measured)
+            self.sizes[id] = size
+        return size[0]
+
+    def sessions(self, running=True):
+        """Per-user idle time and memory, most recently used first.  With
+        running False the store is not asked which users are running."""
+        now = time.time()
+        result = []
+        for id in set(self.cookie.keys()) | set(self.store.ids()):
+            last = self.touched.get(id, now)
+            session = {"id": id, "last": last, "idle": int(now - last), "bytes": self.session_size(id)}
+            if running:
+                session["running"] = self.is_running(id)
+            result.append(session)
+        return sorted(result, key=itemgetter("last"), reverse=True)
+
+    def drop(self, id):
+        with self.lock(id):
+            self.cookie.pop(id, None)
+            self.touched.pop(id, None)
+            self.sizes.pop(id, None)
+            self.store.drop(id)
+
+    def evict(self, ttl, budget):
+        """Drop users idle for more than ttl seconds, then the least recently
+        used ones until everything held fits in budget bytes.  Users with a
+        search or graph still running are never dropped.  Returns the ids dropped."""
+        evicted = []
+        sessions = self.sessions(False)
+        known = set(session["id"] for session in sessions)
+        for id in self.touched.keys():
+            if not id in known:
+                self.touched.pop(id, None)
+        for id in self.sizes.keys():
+            if not id in known:
+                self.sizes.pop(id, None)
+        total = sum(session["bytes"] for session in sessions)
+        # Oldest first, so the budget pass takes the least recently used
+        for session in reversed(sessions):
+            if session["idle"] <= ttl and total <= budget:
+                continue
+            # Used again since it was listed, or still searching
+            if self.touched.get(session["id"], 0) > session["last"] or self.is_running(session["id"]):
+                continue
+            self.drop(session["id"])
+            total -= session["bytes"]
+            evicted.append(session["id"])
+        return evicted
 
 
 class BaseHandler(tornado.web.RequestHandler):
+    validated = {}
+
     @property
     def backend(self):
         return Backend.instance()
 
     def prepare(self):
+        geni.set_interactive()
         self.set_header('P3P', 'CP="HONK"')
         if self.request.protocol == "http":
             self.redirect("https://%s" % self.request.full_url()[len("http://"):], permanent=True)
@@ -448,6 +546,12 @@ class BaseHandler(tornado.web.RequestHandler):
                 'refresh_token': self.get_secure_cookie("refresh_token"),
                 'name': self.get_secure_cookie("name"), 'account_type': self.get_secure_cookie("account_type"),
                 'curator': self.get_secure_cookie("curator"), 'big_tree': self.get_secure_cookie("big_tree")}
+        #A worker may have refreshed the token since the cookie was set
+        tokens = geni.token_manager(options).latest(user["access_token"])
+        if tokens and tokens[0] != user["access_token"]:
+            user["access_token"], user["refresh_token"] = tokens
+            self.set_secure_cookie("access_token", tokens[0])
+            self.set_secure_cookie("refresh_token", tokens[1])
         return user
 
 
@@ -460,34 +564,64 @@ class BaseHandler(tornado.web.RequestHandler):
         else:
             return
 
-    def get_refresh_token(self, next=None):
+    @gen.coroutine
+    def validate_token(self):
+        """Check the user's access token with Geni without blocking the IOLoop.
+        Tokens found valid are not checked again for validate_ttl seconds.
+        Redirects and returns False when the token is no good."""
+        user = self.current_user
+        access_token = user["access_token"]
+        now = time.time()
+        if BaseHandler.validated.get(access_token, 0) > now:
+            raise gen.Return(True)
+        validate = "https://www.geni.com/platform/oauth/validate_token?" + urllib.urlencode({
+            "access_token": access_token,
+        })
+        try:
+            response = yield tornado.httpclient.AsyncHTTPClient().fetch(validate)
+            redata = response.body
+        except tornado.httpclient.HTTPError, e:
+            if not e.response:
+                self.redirect(self.get_login_url(self.request.uri))
+                raise gen.Return(False)
+            redata = e.response.body or "error"
+        except:
+            self.redirect(self.get_login_url(self.request.uri))
+            raise gen.Return(False)
+        if "error" in redata:
+            next = yield self.get_refresh_token(self.request.uri)
+            self.redirect(next)
+            raise gen.Return(False)
+        if len(BaseHandler.validated) > 10000:
+            for key, expires in BaseHandler.validated.items():
+                if expires < now:
+                    del BaseHandler.validated[key]
+        BaseHandler.validated[access_token] = now + options.validate_ttl
+        raise gen.Return(True)
+
+    def absolute_next(self, next=None):
         if not next:
             next = self.request.full_url()
         if not next.startswith("http://") and not next.startswith("https://") and \
                 not next.startswith("http%3A%2F%2F") and not next.startswith("https%3A%2F%2F"):
             next = urlparse.urljoin(self.request.full_url(), next)
-        next = next.replace("http:", self.request.protocol + ":")
+        return next.replace("http:", self.request.protocol + ":")
+
+    @gen.coroutine
+    def get_refresh_token(self, next=None):
+        """Refresh the user's access token and return the url to send them to:
+        next when that worked, otherwise the login url."""
+        next = self.absolute_next(next)
         user = self.current_user
-        if user and "refresh_token" in user:
-            redirect_uri = self.request.protocol + "://" + self.request.host + self.request.uri
-            refresh = "https://www.geni.com/platform/oauth/request_token?" + urllib.urlencode({
-                "refresh_token": user["refresh_token"],
-                "grant_type": "refresh_token",
-                "redirect_uri": redirect_uri,
-                "client_id": self.settings.get("geni_app_id"),
-                "client_secret": self.settings.get("geni_secret"),
-                })
-            response = urllib.urlopen(refresh)
-            redata = response.read()
-            if "error" in redata:
-                return self.get_login_url(next)
-            else:
-                mytoken = json.loads(redata)
-                self.set_secure_cookie("access_token", mytoken["access_token"])
-                self.set_secure_cookie("refresh_token", mytoken["refresh_token"])
-            return next
-        else:
-            return self.get_login_url(next)
+        if user and user.get("refresh_token"):
+            tokens = geni.token_manager(options)
+            tokens.token(user["access_token"], user["refresh_token"])
+            mytoken = yield tokens.refresh_async(user["access_token"])
+            if mytoken:
+                self.set_secure_cookie("access_token", mytoken[0])
+                self.set_secure_cookie("refresh_token", mytoken[1])
+                raise gen.Return(next)
+        raise gen.Return(self.get_login_url(next))
 
     def get_login_url(self, next=None):
         if not next:
@@ -554,19 +688,20 @@ class BaseHandler(tornado.web.RequestHandler):
                     return "true"
         return "false"
 
+    @gen.coroutine
     def isPro(self, user=None):
         selfcheck = False
         if not user:
             selfcheck = True
             user = self.current_user
         if user and "account_type" in user and user["account_type"] == "pro":
-            return True
+            raise gen.Return(True)
         if selfcheck and user and "id" in user:
-            profileinfo = self.backend.get_profile(user["id"], user)
+            profileinfo = yield self.backend.get_profile_async(user["id"], user)
             if profileinfo and "account_type" in profileinfo and profileinfo["account_type"] == "pro":
                 user["account_type"] = "pro"
-                return True
-        return False
+                raise gen.Return(True)
+        raise gen.Return(False)
 
     def isClaimed(self, user=None):
         if not user:
@@ -585,6 +720,7 @@ class BaseHandler(tornado.web.RequestHandler):
 
 class AccountRequest(BaseHandler):
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         profile = self.get_argument("profile", None)
         action = self.get_argument("action", None)
@@ -592,7 +728,7 @@ class AccountRequest(BaseHandler):
             curator = self.isCurator()
             if curator:
                 user = self.current_user
-                profileinfo = self.backend.get_profile(profile, user)
+                profileinfo = yield self.backend.get_profile_async(profile, user)
                 if "id" in profileinfo and "id" in user:
                     if action == "add_user":
                         self.backend.add_smartaccess(profileinfo["id"], user["id"])
@@ -601,10 +737,10 @@ class AccountRequest(BaseHandler):
         else:
             if profile:
                 user = self.current_user
-                profileinfo = self.backend.get_profile(profile, user)
+                profileinfo = yield self.backend.get_profile_async(profile, user)
                 bigtree = self.inBigTree(profileinfo)
                 authorized = self.isAuthorized(profileinfo)
-                pro = self.isPro(profileinfo)
+                pro = yield self.isPro(profileinfo)
                 claimed = self.isClaimed(profileinfo)
                 curator = self.isCurator(False, profileinfo)
             else:
@@ -617,7 +753,7 @@ class AccountRequest(BaseHandler):
                     authorized = "true"
                     bigtree = True
                 else:
-                    pro = self.isPro()
+                    pro = yield self.isPro()
                     authorized = self.isAuthorized()
                     bigtree = self.inBigTree()
             self.write('{"curator": ' + str(curator).lower() + ', "pro": ' + str(pro).lower() + ', "big_tree": ' + str(bigtree).lower() + ', "user": ' + authorized + ', "claimed": ' + str(claimed).lower() + '}')
@@ -771,6 +907,7 @@ class LeaderBoard(BaseHandler):
 class LeaderAdd(BaseHandler):
     @tornado.web.asynchronous
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self):
         user = self.current_user
         f = open('curators.html', 'r')
@@ -781,7 +918,7 @@ class LeaderAdd(BaseHandler):
         for item in r:
             part = item.split("/")
             guid = "g" + str(part[1])
-            profile = self.backend.get_profile(guid, user)
+            profile = yield self.backend.get_profile_async(guid, user)
             mug = profile["mugshot_urls"]["thumb2"]
             if "display_name" in profile:
                 name = profile["display_name"]
@@ -797,19 +934,11 @@ class LeaderAdd(BaseHandler):
 class LeaderUpdate(BaseHandler):
     @tornado.web.asynchronous
     @tornado.web.authenticated
+    @gen.coroutine
     def get(self):
         user = self.current_user
-        try:
-            validate = "https://www.geni.com/platform/oauth/validate_token?" + urllib.urlencode({
-                "access_token": user["access_token"],
-            })
-            response = urllib.urlopen(validate)
-            redata = response.read()
-            if "error" in redata:
-                self.redirect(self.get_refresh_token(self.request.uri))
-                return
-        except:
-            self.redirect(self.get_login_url(self.request.uri))
+        valid = yield self.validate_token()
+        if not valid:
             return
         self.render("leaderupdate.html")
         profiles = self.backend.get_curators()
@@ -927,7 +1056,7 @@ class LeaderUpdate(BaseHandler):
         for person in profiles:
             id = person["id"]
             try:
-                profile = self.backend.get_profile(id, user)
+                profile = yield self.backend.get_profile_async(id, user)
                 if "mugshot_urls" in profile:
                     if "thumb2" in profile["mugshot_urls"]:
                         mug = profile["mugshot_urls"]["thumb2"]
@@ -1014,19 +1143,10 @@ class ProjectWorker(threading.Thread):
 class ProjectHandler(BaseHandler):
     @tornado.web.authenticated
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
-        user = self.current_user
-        try:
-            validate = "https://www.geni.com/platform/oauth/validate_token?" + urllib.urlencode({
-                "access_token": user["access_token"],
-            })
-            response = urllib.urlopen(validate)
-            redata = response.read()
-            if "error" in redata:
-                self.redirect(self.get_refresh_token(self.request.uri))
-                return
-        except:
-            self.redirect(self.get_login_url(self.request.uri))
+        valid = yield self.validate_token()
+        if not valid:
             return
 
         delete = self.get_argument("delete", None)
@@ -1075,6 +1195,22 @@ class TreeComplete(BaseHandler):
                     problems=problems, pconflict=pconflict, count=count, matchcount=matchcount)
 
 
+class SessionsHandler(BaseHandler):
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def get(self):
+        if not self.isCurator():
+            self.write(
+                "This page is only available for Curators and Geni Staff.  If you're one of these and want access, <a href='https://www.geni.com/profile-16675621'>send me a message</a>.")
+            self.finish()
+            return
+        sessions = self.application.linkHolder.sessions()
+        total = sum(session["bytes"] for session in sessions)
+        self.set_header("Cache-control", "no-cache")
+        self.render("sessions.html", sessions=sessions, total=total, ttl=options.session_ttl,
+                    budget=options.session_budget_mb * 1024 * 1024, stats=geni.transport_stats())
+
+
 class PrivacyHandler(BaseHandler):
     @tornado.web.asynchronous
     def get(self):
@@ -1091,24 +1227,16 @@ class BioHandler(BaseHandler):
 class GraphHandler(BaseHandler):
     @tornado.web.authenticated
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         user = self.current_user
-        try:
-            validate = "https://www.geni.com/platform/oauth/validate_token?" + urllib.urlencode({
-                "access_token": user["access_token"],
-            })
-            response = urllib.urlopen(validate)
-            redata = response.read()
-            if "error" in redata:
-                self.redirect(self.get_refresh_token(self.request.uri))
-                return
-        except:
-            self.redirect(self.get_login_url(self.request.uri))
+        valid = yield self.validate_token()
+        if not valid:
             return
 
         profile_id = self.get_argument("profile", user["id"])
         if profile_id:
-            info = self.backend.get_profile_info(profile_id, user)
+            info = yield self.backend.get_profile_info_async(profile_id, user)
             if info and "name" in info:
                 username = info["name"]
             else:
@@ -1242,7 +1370,7 @@ class GraphProcess(BaseHandler):
         elif limit > 15:
             limit = 15
         self.application.linkHolder.set(user["id"], "graphcount", 0)
-        self.application.linkHolder.set(user["id"], "graphprofile", profile)
+        self.application.linkHolder.set(user["id"], "graphprofile", geni.profile_id(profile))
         self.application.linkHolder.set(user["id"], "graphlimit", limit - 1)
         self.application.linkHolder.set(user["id"], "graphorder", order)
         self.application.linkHolder.set(user["id"], "dna", dna)
@@ -1264,12 +1392,16 @@ class GraphCount(BaseHandler):
         user = self.current_user
         cookie = self.application.linkHolder
         result = self.get_argument("status", None)
-        count = cookie.get(user["id"], "graphcount")
-        pgcount = cookie.get(user["id"], "pgcount")
-        status = cookie.get(user["id"], "graphrunning")
-        error = cookie.get(user["id"], "accesserror")
-        orderid = cookie.get(user["id"], "graphorder")
-        cookie.set(user["id"], "accesserror", None)
+        values = cookie.snapshot(user["id"], ("graphcount", "pgcount", "graphrunning", "accesserror", "graphorder",
+                                              "unavailable"))
+        count = values["graphcount"]
+        pgcount = values["pgcount"]
+        status = values["graphrunning"]
+        error = values["accesserror"]
+        orderid = values["graphorder"]
+        if error:
+            cookie.set(user["id"], "accesserror", None)
+        unavailable = values["unavailable"] or self.backend.geni_unavailable()
         order = "Ancestors"
         if orderid:
             if orderid == 1:
@@ -1288,6 +1420,9 @@ class GraphCount(BaseHandler):
             cookie.set(user["id"], "graphrunning", 1)
             cookie.set(user["id"], "graphcount", 0)
             cookie.set(user["id"], "pgcount", 0)
+            cookie.set(user["id"], "unavailable", None)
+            # The snapshot may still hold the flag of a halted earlier run
+            unavailable = self.backend.geni_unavailable()
             count = 0
             pgcount = 0
         if not status:
@@ -1298,7 +1433,7 @@ class GraphCount(BaseHandler):
         except:
             pass
         self.set_header("Cache-control", "no-cache")
-        self.render("graphcount.html", count=count, status=status, error=error)
+        self.render("graphcount.html", count=count, status=status, error=error, unavailable=unavailable)
 
     @tornado.web.authenticated
     def post(self):
@@ -1325,24 +1460,16 @@ class GraphList(BaseHandler):
 class HistoryHandler(BaseHandler):
     @tornado.web.authenticated
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         user = self.current_user
-        try:
-            validate = "https://www.geni.com/platform/oauth/validate_token?" + urllib.urlencode({
-                "access_token": user["access_token"],
-            })
-            response = urllib.urlopen(validate)
-            redata = response.read()
-            if "error" in redata:
-                self.redirect(self.get_refresh_token(self.request.uri))
-                return
-        except:
-            self.redirect(self.get_login_url(self.request.uri))
+        valid = yield self.validate_token()
+        if not valid:
             return
 
         profile_id = self.get_argument("profile", None)
         if profile_id:
-            info = self.backend.get_profile_info(profile_id, user)
+            info = yield self.backend.get_profile_info_async(profile_id, user)
             if "name" in info:
                 username = info["name"]
             else:
@@ -1418,12 +1545,15 @@ class HistoryCount(BaseHandler):
             cookie.set(user["id"], "running", 1)
             stage = "parent's family"
 
-        count = cookie.get(user["id"], "count")
-        stage = cookie.get(user["id"], "stage")
-        status = cookie.get(user["id"], "running")
-        hits = cookie.get(user["id"], "hits")
-        error = cookie.get(user["id"], "accesserror")
-        cookie.set(user["id"], "accesserror", None)
+        values = cookie.snapshot(user["id"], ("count", "stage", "running", "hits", "accesserror", "unavailable"))
+        count = values["count"]
+        stage = values["stage"]
+        status = values["running"]
+        hits = values["hits"]
+        error = values["accesserror"]
+        if error:
+            cookie.set(user["id"], "accesserror", None)
+        unavailable = values["unavailable"] or self.backend.geni_unavailable()
         match = cookie.get_matchcount(user["id"])
         try:
             logging.info(
@@ -1432,7 +1562,8 @@ class HistoryCount(BaseHandler):
         except:
             pass
         self.set_header("Cache-control", "no-cache")
-        self.render("historycount.html", count=count, status=status, stage=stage, hits=hits, match=match, error=error)
+        self.render("historycount.html", count=count, status=status, stage=stage, hits=hits, match=match, error=error,
+                    unavailable=unavailable)
 
     @tornado.web.authenticated
     def post(self):
@@ -1500,7 +1631,7 @@ class HistoryProcess(BaseHandler):
         cookie.set(user["id"], "masterselect", masterselect)
         cookie.set(user["id"], "projectselect", projectselect)
         cookie.set(user["id"], "followselect", followselect)
-        cookie.set(user["id"], "rootprofile", profile)
+        cookie.set(user["id"], "rootprofile", geni.profile_id(profile))
 
         args = {"user": user, "base": self}
         HistoryWorker(self.worker_done, args).start()
@@ -1517,6 +1648,8 @@ class HistoryWorker(threading.Thread):
         self.user = args[0]["user"]
         self.base = args[0]["base"]
         self.cookie = self.base.application.linkHolder
+        self.batch = geni.batch_controller("history", options)
+        self.scheduler = geni.crawl_scheduler(options)
         args = {}
         super(HistoryWorker, self).__init__(*args, **kwargs)
         self.callback = callback
@@ -1525,30 +1658,104 @@ class HistoryWorker(threading.Thread):
         profile = self.user["id"]
         rootprofile = self.cookie.get(profile, "rootprofile")
         if not rootprofile:
-            rootprofile = profile
-        self.cookie.set_familyroot(profile, [rootprofile])
-        limit = self.cookie.get(profile, "limit")
-        #family_root.append(rootprofile)
-        gen = 0
-        self.setGeneration(gen)
-        self.cookie.remove_parentmatch(profile, gen - 1)
-        while len(self.cookie.get_familyroot(profile)) > 0:
-            root = []
-            root.extend(self.cookie.get_familyroot(profile))
-            self.cookie.set_familyroot(profile, [])
-
-            threads = 30
-            profilesAtOnce = 6
-            if not limit or int(limit) > gen:
-                self.threadme(root, threads, profilesAtOnce)
-                if len(self.cookie.get_familyroot(profile)) > 0:
-                    gen += 1
-                    self.setGeneration(gen)
-            # Set the display for the completed Generation
-        self.setGenerationLabel(gen - 1)
+            rootprofile = geni.profile_id(profile)
+        self.limit = self.cookie.get(profile, "limit")
+        self.fields = geni.family_fields(master=self.cookie.get(profile, "master"),
+                                         merges=self.cookie.get(profile, "merges"),
+                                         follow=self.cookie.get(profile, "follow"),
+                                         project=self.cookie.get(profile, "project"),
+                                         problem=self.cookie.get(profile, "problem"),
+                                         complete=self.cookie.get(profile, "complete"))
+        # Profiles waiting for a family lookup, by generation.  Parents found
+        # by any finished slice are queued right away, so a slow slice holds
+        # up its own branches only and not the next generation.
+        self.frontier = {}
+        self.inflight = 0
+        self.deepest = 0
+        # Families counted for tree completeness, by (generation, profile)
+        self.expanded = {}
+        self.ready = threading.Condition()
+        # Slices beyond what the scheduler runs for one user at a time would
+        # only wait in its queue, cut at a batch size that may be out of date
+        threads = self.scheduler.cap
+        printlock = threading.Lock()
+        crawled = 0
+        self.setGeneration(crawled)
+        self.cookie.remove_parentmatch(profile, -1)
+        self.enqueue(rootprofile, 0)
+        while not self.checkdone():
+            with self.ready:
+                while self.inflight and (not self.frontier or self.inflight >= threads):
+                    self.ready.wait()
+                if not self.frontier:
+                    break
+                # Shallower generations first, which keeps the parent matches
+                # of a profile complete by the time its own family is read
+                gen = min(self.frontier)
+                size = self.batch.current()
+                family_list = self.frontier[gen][:size]
+                del self.frontier[gen][:size]
+                if not self.frontier[gen]:
+                    del self.frontier[gen]
+                self.inflight += 1
+            if gen > crawled:
+                crawled = gen
+                self.setGeneration(gen)
+            self.scheduler.submit(profile, self.crawl, SubWorker(self, family_list, gen, printlock),
+                                  cost=len(family_list))
+        with self.ready:
+            while self.inflight:
+                self.ready.wait()
+        # Set the display for the completed Generation
+        self.setGeneration(self.deepest)
+        self.setGenerationLabel(self.deepest - 1)
         self.cookie.set(profile, "running", 0)
         self.callback('DONE')
 
+    def crawl(self, worker):
+        try:
+            worker.run()
+        finally:
+            with self.ready:
+                self.inflight -= 1
+                self.ready.notify()
+
+    def enqueue(self, id, gen):
+        """Queue id for a family lookup at generation gen, once per generation
+        and only within the generation limit."""
+        if not self.cookie.add_history(self.user["id"], gen, id):
+            return
+        with self.ready:
+            self.deepest = max(self.deepest, gen)
+            if not self.limit or int(self.limit) > gen:
+                self.frontier.setdefault(gen, []).append(id)
+                self.ready.notify()
+
+    def count_family(self, gen, id, parentscount, mastercount, parents):
+        """Add a family at gen to the tree completeness.  A profile reached
+        through several lines of descent counts once per line, including lines
+        found after its family was counted."""
+        profile = self.user["id"]
+        with self.ready:
+            weight = max(1, self.cookie.get_parentmatch(profile, gen, id))
+            self.expanded[(gen, id)] = (parentscount, mastercount, parents)
+            self.cookie.addParentCount(profile, gen, parentscount * weight, mastercount * weight)
+            for parent in parents:
+                self.add_parent(gen, parent, weight)
+
+    def add_parent(self, gen, id, count):
+        """Count count more lines of descent to id as a parent of a profile at gen."""
+        profile = self.user["id"]
+        before = max(1, self.cookie.get_parentmatch(profile, gen + 1, id))
+        self.cookie.add_parentmatch(profile, gen + 1, id, count)
+        if (gen + 1, id) in self.expanded:
+            parentscount, mastercount, parents = self.expanded[(gen + 1, id)]
+            extra = max(1, self.cookie.get_parentmatch(profile, gen + 1, id)) - before
+            if extra:
+                self.cookie.addParentCount(profile, gen + 1, parentscount * extra, mastercount * extra)
+                for parent in parents:
+                    self.add_parent(gen + 1, parent, extra)
+
     def checkdone(self):
         if self.cookie.get(self.user["id"], "running") == 0:
             return True
@@ -1572,45 +1779,12 @@ class HistoryWorker(threading.Thread):
                 match.append(item)
         return match
 
-    def threadme(self, root, threadlimit=None, idlimit=10, timeout=0.05):
-        assert threadlimit > 0, "need at least one thread";
-        printlock = threading.Lock()
-        threadpool = []
-
-        # keep going while work to do or being done
-        while root or threadpool:
-            done = self.checkdone()
-            if done:
-                break
-            parent_list = []
-            # while there's room, remove source files
-            # and add to the pool
-            while root and (threadlimit is None or len(threadpool) < threadlimit):
-                i = idlimit
-                sub_root = []
-                while i > 0:
-                    sub_root.append(root.pop())
-                    if len(root) > 0:
-                        i -= 1
-                    else:
-                        i = 0
-                wrkr = SubWorker(self, sub_root, printlock)
-                wrkr.start()
-                threadpool.append(wrkr)
-
-            # remove completed threads from the pool
-            for thr in threadpool:
-                thr.join(timeout=timeout)
-                if not thr.is_alive():
-                    threadpool.remove(thr)
-                    #print("all threads are done")
-
-
-class SubWorker(threading.Thread):
-    def __init__(self, root, family_list, printlock, **kwargs):
-        super(SubWorker, self).__init__(**kwargs)
+
+class SubWorker(object):
+    def __init__(self, root, family_list, gen, printlock):
         self.root = root
         self.family_list = family_list
+        self.gen = gen
         self.lock = printlock # so threads don't step on each other's prints
 
     def run(self):
@@ -1621,22 +1795,27 @@ class SubWorker(threading.Thread):
         running = self.root.cookie.get(profile, "running")
         if running == 0:
             return
-        the_group = self.root.base.backend.get_family_group(self.family_list, self.root.user)
-        master = self.root.cookie.get(profile, "master")
-        problem = self.root.cookie.get(profile, "problem")
-        project = self.root.cookie.get(profile, "project")
-        complete = self.root.cookie.get(profile, "complete")
-        siblings = self.root.cookie.get(profile, "siblings")
-        follow = self.root.cookie.get(profile, "follow")
-        followselect = self.root.cookie.get(profile, "followselect")
-        merges = self.root.cookie.get(profile, "merges")
-        masterselect = self.root.cookie.get(profile, "masterselect")
-        projectselect = self.root.cookie.get(profile, "projectselect")
+        the_group = self.root.base.backend.get_family_group(self.family_list, self.root.user, self.root.batch,
+                                                            self.root.fields)
+        settings = self.root.cookie.snapshot(profile, ("master", "problem", "project", "complete", "siblings", "follow",
+                                                       "followselect", "merges", "masterselect", "projectselect"))
+        master = settings["master"]
+        problem = settings["problem"]
+        project = settings["project"]
+        complete = settings["complete"]
+        siblings = settings["siblings"]
+        follow = settings["follow"]
+        followselect = settings["followselect"]
+        merges = settings["merges"]
+        masterselect = settings["masterselect"]
+        projectselect = settings["projectselect"]
         if the_group == "Invalid access token":
             self.root.cookie.stop(profile)
             self.root.base.set_secure_cookie("access_token", "")
             self.root.cookie.set(profile, "accesserror", True)
             the_group = None
+        elif not the_group and self.root.base.backend.geni_unavailable():
+            self.root.cookie.halt(profile, "unavailable")
         if the_group:
             for this_family in the_group:
                 rematch = None
@@ -1665,7 +1844,7 @@ class SubWorker(threading.Thread):
                     relatives = theparents
                 else:
                     relatives = this_family.get_family_branch_group()
-                gen = self.root.cookie.get(profile, "gen")
+                gen = self.gen
 
                 if complete:
                     rootprofile = this_family.get_focus()
@@ -1685,17 +1864,8 @@ class SubWorker(threading.Thread):
                         mastercount += 1
 
                 if rootprofile:
-                    rootcount = self.root.cookie.get_parentmatch(profile, gen, rootprofile)
-                    if rootcount == 0:
-                        self.root.cookie.addParentCount(profile, gen, parentscount, mastercount)
-                    else:
-                        self.root.cookie.addParentCount(profile, gen, parentscount * rootcount, mastercount * rootcount)
-                    for parent in theparents:
-                        self.root.cookie.add_parentmatch(profile, gen + 1, parent.get_id())
-                    while rootcount > 1:
-                        rootcount -= 1
-                        for parent in theparents:
-                            self.root.cookie.add_parentmatch(profile, gen + 1, parent.get_id())
+                    self.root.count_family(gen, rootprofile, parentscount, mastercount,
+                                           [parent.get_id() for parent in theparents])
                 for relative in relatives:
                     relativeprojects = relative.get_projects()
                     if (project or problem) and len(relativeprojects) > 0:
@@ -1760,39 +1930,12 @@ class SubWorker(threading.Thread):
                     elif follow and relative.is_public():
                         self.root.base.backend.unfollow(relative.get_id(), self.root.user)
 
-                count = int(self.root.cookie.get(profile, "count")) + len(relatives)
-                probcount = self.root.cookie.get(profile, "problems") + probcount
-                pendcount = self.root.cookie.get(profile, "pending") + pendcount
-                mpcount = self.root.cookie.get(profile, "mpcount") + mpcount
-                pconflict = self.root.cookie.get(profile, "pconflict") + pconflict
-                self.root.cookie.set(profile, "problems", probcount)
-                self.root.cookie.set(profile, "pconflict", pconflict)
-                self.root.cookie.set(profile, "count", count)
-                self.root.cookie.set(profile, "pending", pendcount)
-                self.root.cookie.set(profile, "mpcount", mpcount)
-                history = self.root.cookie.get_history(profile)
-                for parent in theparents:
-                    if not rematch and parent not in history:
-                        self.root.cookie.append_familyroot(profile, parent.get_id())
-                self.root.cookie.add_history(profile, self.root.cookie.get_familyroot(profile))
-
-            if complete:
-                for this_family in the_group:
-                    rootprofile = this_family.get_focus()
-                    if rootprofile:
-                        theparents = this_family.get_parents()
-                        parentscount = len(theparents)
-                        gen = self.root.cookie.get(profile, "gen")
-                        if not gen:
-                            return
-                        rootcount = self.root.cookie.get_parentmatch(profile, gen + 1, rootprofile)
-                        if rootcount > 0:
-                            self.root.cookie.addParentCount(profile, gen + 1, parentscount * rootcount,
-                                                            mastercount * rootcount)
-                            while rootcount > 0:
-                                rootcount -= 1
-                                for parent in theparents:
-                                    self.root.cookie.add_parentmatch(profile, gen + 2, parent.get_id())
+                self.root.cookie.add_counts(profile, {"count": len(relatives), "problems": probcount,
+                                                      "pending": pendcount, "mpcount": mpcount,
+                                                      "pconflict": pconflict})
+                if not rematch:
+                    for parent in theparents:
+                        self.root.enqueue(parent.get_id(), gen + 1)
 
 
 class GraphWorker(threading.Thread):
@@ -1802,6 +1945,7 @@ class GraphWorker(threading.Thread):
         self.adopt = args[0]["adopt"]
         self.cookie = self.base.application.linkHolder
         self.geni = self.base.backend
+        self.scheduler = geni.crawl_scheduler(options)
         self.genstop = self.cookie.get(self.user["id"], "graphlimit")
         self.order = self.cookie.get(self.user["id"], "graphorder")
         self.dna = self.cookie.get(self.user["id"], "dna")
@@ -1821,7 +1965,7 @@ class GraphWorker(threading.Thread):
     def run(self):
         profile = self.cookie.get(self.user["id"], "graphprofile") #"profile-34621975384"
         if not profile:
-            profile = self.user["id"]
+            profile = geni.profile_id(self.user["id"])
             #running = self.cookie.get(profile, "running")
             #if running == 0:
             #return
@@ -1848,7 +1992,8 @@ class GraphWorker(threading.Thread):
                 return
             if len(focusfamily) < 1:
                 logging.error("*** No Family in Array")
-                self.cookie.set(self.user["id"], "graphrunning", 0)
+                if not self.geniUnavailable():
+                    self.cookie.set(self.user["id"], "graphrunning", 0)
                 return
             family = focusfamily[0]
             if isinstance(family, str):
@@ -1888,6 +2033,7 @@ class GraphWorker(threading.Thread):
                     return
             except:
                 logging.error("Problem getting JSON from Geni - Quiting")
+                self.geniUnavailable()
                 self.cookie.set(self.user["id"], "graphrunning", 2)
                 return
         if not person:
@@ -1924,27 +2070,27 @@ class GraphWorker(threading.Thread):
                 if not isinstance(person, str):
                     query_root.append(person.get_id())
 
-            query_root = self.chunks(query_root, 50)
-            for persons in query_root:
+            batch = geni.batch_controller("graph", options)
+            # The chunks of a generation are fetched side by side on the scheduler
+            tasks = []
+            while query_root:
                 #I think this is what takes a while - generate random number, save to cookie, check after to make sure it's the same.
                 if self.graphStopped() or self.deadProcess():
                     #print ("*** quiting ****")
                     return
-                try:
-                    families = self.get_families(persons)
-                except:
-                    logging.info("Problem getting JSON from Geni - Trying Again 1")
-                    traceback.print_exc()
-                    try:
-                        families = self.get_families(persons)
-                    except:
-                        logging.info("Problem getting JSON from Geni - Trying Again 2")
-                        try:
-                            families = self.get_families(persons)
-                        except:
-                            logging.info("Problem getting JSON from Geni - Quiting")
-                            self.cookie.set(self.user["id"], "graphrunning", 2)
-                            return
+                if self.geniUnavailable():
+                    return
+                size = batch.current()
+                persons = query_root[:size]
+                query_root = query_root[size:]
+                tasks.append(self.scheduler.submit(self.user["id"], self.fetch_families, persons, batch,
+                                                   cost=len(persons)))
+            for task in tasks:
+                families = task.result()
+                if families is None:
+                    self.geniUnavailable()
+                    self.cookie.set(self.user["id"], "graphrunning", 2)
+                    return
                 family_root.extend(families)
             query_root = None
             sub_family = [None] * len(sub_root)
@@ -2012,6 +2158,7 @@ class GraphWorker(threading.Thread):
                                 parents = self.get_nextgen(family)
                             except:
                                 logging.error("Problem getting JSON from Geni - Quiting")
+                                self.geniUnavailable()
                                 self.cookie.set(self.user["id"], "graphrunning", 2)
                                 return
 
@@ -2143,11 +2290,27 @@ class GraphWorker(threading.Thread):
 
         self.callback('DONE')
 
-    def get_families(self, persons):
+    def get_families(self, persons, batch=None):
         if self.order == 1:
-            return self.geni.get_family_parents(persons, self.user)
+            return self.geni.get_family_parents(persons, self.user, batch)
         else:
-            return self.geni.get_family_children(persons, self.user)
+            return self.geni.get_family_children(persons, self.user, batch)
+
+    def fetch_families(self, persons, batch):
+        """get_families for one chunk, tried up to three times.  None when every try failed."""
+        if self.graphStopped() or self.deadProcess():
+            return []
+        for attempt in range(1, 4):
+            try:
+                return self.get_families(persons, batch)
+            except:
+                if attempt == 3:
+                    logging.info("Problem getting JSON from Geni - Quiting")
+                else:
+                    logging.info("Problem getting JSON from Geni - Trying Again " + str(attempt))
+                if attempt == 1:
+                    traceback.print_exc()
+        return None
 
     def get_nextgen(self, family):
         if not family:
@@ -2178,6 +2341,13 @@ class GraphWorker(threading.Thread):
     def graphStopped(self):
         return self.cookie.get(self.user["id"], "graphrunning") == 0
 
+    def geniUnavailable(self):
+        if self.geni.geni_unavailable():
+            self.cookie.set(self.user["id"], "unavailable", True)
+            self.cookie.set(self.user["id"], "graphrunning", 2)
+            return True
+        return False
+
     def processJSON(self, tree=None, nid=None, level=None, idhidden=True, filter=None, cmp=None, key=None,
                     reverse=False):
         if self.graphStopped() or self.deadProcess():
@@ -2257,7 +2427,7 @@ class GraphWorker(threading.Thread):
             birthdate = person.get_birth_date()
             birthcirca = person.get_birth_circa()
             birthlocation = person.get_birth_location()
-            id = person.get_id()
+            id = person.get_key()
             group = person.get_group()
             countryvar = person.get_birth_country()
             statevar = person.get_birth_state()
@@ -2464,6 +2634,7 @@ class LoginHandler(BaseHandler):
         mytoken = json.loads(response.body)
         access_token = mytoken["access_token"]
         refresh_token = mytoken["refresh_token"]
+        geni.token_manager(options).register(access_token, refresh_token, mytoken.get("expires_in"))
         url = "https://www.geni.com/api/profile?" + urllib.urlencode({
             "access_token": access_token,
         })
@@ -2527,6 +2698,9 @@ class Backend(object):
         self.db = torndb.Connection(
             host=options.mysql_host, database=options.mysql_database,
             user=options.mysql_user, password=options.mysql_password)
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.clients_swept = time.time()
 
     @classmethod
     def instance(cls):
@@ -2550,9 +2724,9 @@ class Backend(object):
         geni = self.get_API(user)
         return geni.get_profile(profile)
 
-    def get_family_group(self, family_root, user):
+    def get_family_group(self, family_root, user, batch=None, fields=None):
         geni = self.get_API(user)
-        return geni.get_family_group(family_root)
+        return geni.get_family_group(family_root, batch=batch, fields=fields)
 
     def follow(self, profile, user):
         geni = self.get_API(user)
@@ -2562,17 +2736,17 @@ class Backend(object):
         geni = self.get_API(user)
         return geni.unfollow_profile(profile)
 
-    def get_family_parents(self, family_root, user):
+    def get_family_parents(self, family_root, user, batch=None):
         geni = self.get_API(user)
-        return geni.get_family_parents(family_root)
+        return geni.get_family_parents(family_root, batch)
 
     def update_relative(self, relative, user):
         geni = self.get_API(user)
         return geni.update_relative(relative)
 
-    def get_family_children(self, family_root, user):
+    def get_family_children(self, family_root, user, batch=None):
         geni = self.get_API(user)
-        return geni.get_family_children(family_root)
+        return geni.get_family_children(family_root, batch)
 
     def get_master(self, profiles, user):
         geni = self.get_API(user)
@@ -2853,6 +3027,14 @@ class Backend(object):
         geni = self.get_API(user)
         return geni.get_profile_info(profile)
 
+    def get_profile_async(self, profile, user):
+        geni = self.get_async_API(user)
+        return geni.get_profile(profile)
+
+    def get_profile_info_async(self, profile, user):
+        geni = self.get_async_API(user)
+        return geni.get_profile_info(profile)
+
     def get_project_name(self, project, user):
         geni = self.get_API(user)
         return geni.get_project_name(project)
@@ -2866,7 +3048,7 @@ class Backend(object):
         geni = self.get_API(user)
         return geni.request(str(path), args, post_args, post_data)
 
-    def get_API(self, user):
+    def get_tokens(self, user):
         if user:
             access_token = user['access_token']
             refresh_token = user['refresh_token']
@@ -2875,8 +3057,37 @@ class Backend(object):
             geni_secret = options.historylink_secret
             access_token = app_id + "|" + geni_secret
             refresh_token = None
-        giniapi = geni.GeniAPI(access_token, refresh_token, options)
-        return giniapi
+        return access_token, refresh_token
+
+    def get_API(self, user):
+        return self.get_client(geni.GeniAPI, user)
+
+    def geni_unavailable(self):
+        return geni.circuit_breaker(options).is_open()
+
+    def get_async_API(self, user):
+        return self.get_client(geni.AsyncGeniAPI, user)
+
+    def get_client(self, api, user):
+        """The api client for the user's access token.  One client is shared by
+        every call with that token until it sits unused for geni_client_idle seconds."""
+        access_token, refresh_token = self.get_tokens(user)
+        now = time.time()
+        idle = options.geni_client_idle
+        with self.clients_lock:
+            if now - self.clients_swept > 60:
+                for key, entry in self.clients.items():
+                    if now - entry[1] > idle:
+                        del self.clients[key]
+                self.clients_swept = now
+            key = (api, access_token)
+            entry = self.clients.get(key)
+            if entry and now - entry[1] <= idle:
+                client = entry[0]
+            else:
+                client = api(access_token, refresh_token, options)
+            self.clients[key] = (client, now)
+        return client
 
     def query_historyprofiles(self):
         result = None
@@ -3029,11 +3240,16 @@ def main():
         tornado.options.parse_config_file(path)
     from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=options.geni_max_clients)
     #from tornado.wsgi import WSGIContainer
     #http_server = HTTPServer(WSGIContainer(GeniApplication()))
-    http_server = HTTPServer(GeniApplication(), xheaders=True)
+    application = GeniApplication()
+    http_server = HTTPServer(application, xheaders=True)
     #http_server.listen(8080)
     http_server.listen(int(os.environ.get("PORT", 80)))
+    sweeper = threading.Thread(target=application.sweep_sessions, name="session-sweep")
+    sweeper.daemon = True
+    sweeper.start()
     IOLoop.instance().start()
 
 
@@ -15,6 +15,8 @@ class Node(object):
 
     @classmethod
     def sanitize_id(cls, identifier):
+        if isinstance(identifier, (int, long)):
+            return identifier
         return str(identifier).strip().replace(" ", "_")
 
 
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2019 Jeff Gentes
+#
+
+#Storage for the per-user search and graph state LinkHolder publishes.
+#
+#MemoryStore keeps it in this process.  RedisStore keeps it in Redis so the
+#/historycount, /historylist and /graphcount pollers can be answered by any
+#process, not only the one running the job.
+
+import select
+import socket
+import sys
+import threading
+import time
+import logging
+from urlparse import urlsplit
+
+# Find a JSON parser
+try:
+    import simplejson as json
+except ImportError:
+    try:
+        from django.utils import simplejson as json
+    except ImportError:
+        import json
+
+
+def deep_size(value, seen=None):
+    """sys.getsizeof of value and everything it holds, counting shared objects once."""
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += deep_size(key, seen) + deep_size(item, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += deep_size(item, seen)
+    elif hasattr(value, "__slots__"):
+        for name in value.__slots__:
+            size += deep_size(getattr(value, name, None), seen)
+    elif hasattr(value, "__dict__"):
+        size += deep_size(value.__dict__, seen)
+    return size
+
+
+def create_store(options):
+    """The store named by the session_store option: a redis:// URL, or in-process memory."""
+    url = getattr(options, "session_store", None)
+    if url:
+        return RedisStore(RedisClient.from_url(url),
+                          ttl=getattr(options, "session_ttl", None) or 3600,
+                          flush=getattr(options, "session_flush", None) or 0.5)
+    return MemoryStore()
+
+
+class MemoryStore(object):
+    """Session state in a dict of dicts.
+
+    Values, lists and field tables are stored as they are.  Callers serialise
+    writes for a user (LinkHolder holds that user's lock), so there is no
+    locking here.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def session(self, id):
+        if not id in self.data:
+            self.data[id] = {}
+        return self.data[id]
+
+    def get(self, id, key):
+        if id in self.data:
+            return self.data[id].get(key)
+        return None
+
+    def set(self, id, key, value):
+        self.session(id)[key] = value
+
+    def update(self, id, values):
+        self.session(id).update(values)
+
+    def snapshot(self, id, keys):
+        session = self.data.get(id, {})
+        return dict((key, session.get(key)) for key in keys)
+
+    def add(self, id, counts):
+        session = self.session(id)
+        for key in counts:
+            session[key] = (session.get(key) or 0) + counts[key]
+
+    def append(self, id, key, value):
+        session = self.session(id)
+        if not key in session:
+            session[key] = []
+        session[key].append(value)
+        return len(session[key])
+
+    def replace(self, id, key, index, value):
+        self.session(id)[key][index] = value
+
+    def items(self, id, key):
+        return self.data.get(id, {}).get(key) or []
+
+    def length(self, id, key):
+        return len(self.items(id, key))
+
+    def add_field(self, id, key, field, value):
+        session = self.session(id)
+        if not key in session:
+            session[key] = {}
+        session[key][field] = session[key].get(field, 0) + value
+
+    def set_field(self, id, key, field, value):
+        session = self.session(id)
+        if not key in session:
+            session[key] = {}
+        session[key][field] = value
+
+    def fields(self, id, key):
+        return self.data.get(id, {}).get(key) or {}
+
+    def clear(self, id, keys):
+        session = self.session(id)
+        for key in keys:
+            session.pop(key, None)
+
+    def drop(self, id):
+        self.data.pop(id, None)
+
+    def ids(self):
+        return self.data.keys()
+
+    def size(self, id):
+        return deep_size(self.data.get(id, {}))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisUnavailable(RedisError):
+    """The connection failed, so the commands may or may not have been applied."""
+    pass
+
+
+class RedisConnection(object):
+    """One socket speaking RESP, the Redis wire protocol."""
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        self.sent = False
+
+    def stale(self):
+        """True if Redis has closed this idle connection, or sent something unasked."""
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (select.error, socket.error):
+            return True
+
+    def encode(self, command):
+        parts = ["*%d\r\n" % len(command)]
+        for arg in command:
+            if isinstance(arg, unicode):
+                arg = arg.encode("utf-8")
+            elif not isinstance(arg, str):
+                arg = str(arg)
+            parts.append("$%d\r\n%s\r\n" % (len(arg), arg))
+        return "".join(parts)
+
+    def read(self):
+        line = self.file.readline()
+        if not line:
+            raise socket.error("Connection closed by Redis")
+        kind, rest = line[0], line[1:-2]
+        if kind == "+":
+            return rest
+        if kind == "-":
+            return RedisError(rest)
+        if kind == ":":
+            return int(rest)
+        if kind == "$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.file.read(length + 2)
+            return data[:-2]
+        if kind == "*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read() for i in range(length)]
+        raise RedisError("Unexpected reply: " + line)
+
+    def pipeline(self, commands):
+        """Send commands in one write and read their replies.  sent tells
+        whether any of the write went out before a failure."""
+        data = "".join(self.encode(command) for command in commands)
+        self.sent = False
+        count = self.sock.send(data)
+        self.sent = True
+        self.sock.sendall(data[count:])
+        return [self.read() for command in commands]
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class RedisClient(object):
+    """Minimal thread-safe Redis client.  Each call borrows an idle connection
+    (or opens one), sends its commands in one write and reads the replies."""
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url):
+        parts = urlsplit(url)
+        db = parts.path.strip("/")
+        return cls(parts.hostname or "localhost", parts.port or 6379, int(db) if db else 0, parts.password)
+
+    def connect(self):
+        connection = RedisConnection(self.host, self.port, self.timeout)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        for reply in connection.pipeline(setup):
+            if isinstance(reply, RedisError):
+                connection.close()
+                raise reply
+        return connection
+
+    def pipeline(self, commands):
+        """Replies for commands, in order.  Commands are only sent again on
+        another connection when nothing of them went out on the first; after
+        that HINCRBY or RPUSH may already have been applied, so the failure
+        is raised as RedisUnavailable."""
+        if not commands:
+            return []
+        while True:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            pooled = connection is not None
+            if pooled and connection.stale():
+                connection.close()
+                continue
+            try:
+                if not pooled:
+                    connection = self.connect()
+                replies = connection.pipeline(commands)
+            except (socket.error, socket.timeout), e:
+                if connection:
+                    connection.close()
+                if pooled and not connection.sent:
+                    continue
+                raise RedisUnavailable("Redis unavailable: " + str(e))
+            with self.lock:
+                self.idle.append(connection)
+            for reply in replies:
+                if isinstance(reply, RedisError):
+                    raise reply
+            return replies
+
+    def execute(self, *command):
+        return self.pipeline([command])[0]
+
+
+class RedisStore(object):
+    """Session state in Redis, shared by every process.
+
+    A user's values live in one hash, with JSON-encoded values.  Lists (the
+    matches) and field tables (the per-generation counts) get keys of their
+    own.  Every write renews the keys' expiry to ttl seconds.
+
+    Counter updates are buffered and sent at most every flush seconds as one
+    pipeline.  Any read or write of the same user sends them first.
+    """
+
+    prefix = "historylink:"
+
+    def __init__(self, client, ttl=3600, flush=0.5):
+        self.client = client
+        self.ttl = ttl
+        self.flush_interval = flush
+        self.pending = {}
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+
+    def key(self, id, key=None):
+        if key:
+            return "%s%s:%s" % (self.prefix, id, key)
+        return "%s%s" % (self.prefix, id)
+
+    def decode(self, value):
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def take(self, id=None):
+        """Buffered counters for one user, or for everyone."""
+        with self.lock:
+            if id is None:
+                pending, self.pending = self.pending, {}
+                self.flushed = time.time()
+            else:
+                pending = {}
+                if id in self.pending:
+                    pending[id] = self.pending.pop(id)
+        return pending
+
+    def requeue(self, pending):
+        """Put counters back in the buffer after the connection failed sending them.
+        Redis may have applied them before it broke, so they can count twice."""
+        with self.lock:
+            for user in pending:
+                counts = self.pending.setdefault(user, {})
+                for key in pending[user]:
+                    counts[key] = counts.get(key, 0) + pending[user][key]
+
+    def counters(self, pending):
+        commands = []
+        for user in pending:
+            for key in pending[user]:
+                commands.append(("HINCRBY", self.key(user), key, pending[user][key]))
+            commands.append(("EXPIRE", self.key(user), self.ttl))
+        return commands
+
+    def run(self, id, commands, keys=()):
+        """Send id's buffered counters, then commands and expiry renewals, in one round trip.
+        Returns the replies to commands."""
+        pending = self.take(id)
+        counters = self.counters(pending)
+        renew = [("EXPIRE", self.key(id, key), self.ttl) for key in keys]
+        try:
+            replies = self.client.pipeline(counters + list(commands) + renew)
+        except RedisUnavailable:
+            self.requeue(pending)
+            raise
+        return replies[len(counters):len(counters) + len(commands)]
+
+    def get(self, id, key):
+        return self.decode(self.run(id, [("HGET", self.key(id), key)])[0])
+
+    def set(self, id, key, value):
+        self.update(id, {key: value})
+
+    def update(self, id, values):
+        command = ["HSET", self.key(id)]
+        for key in values:
+            command.extend([key, json.dumps(values[key])])
+        self.run(id, [command, ("EXPIRE", self.key(id), self.ttl)])
+
+    def snapshot(self, id, keys):
+        keys = list(keys)
+        values = self.run(id, [["HMGET", self.key(id)] + keys])[0]
+        return dict((key, self.decode(value)) for key, value in zip(keys, values))
+
+    def add(self, id, counts):
+        with self.lock:
+            if not id in self.pending:
+                self.pending[id] = {}
+            for key in counts:
+                if counts[key]:
+                    self.pending[id][key] = self.pending[id].get(key, 0) + counts[key]
+            due = time.time() - self.flushed >= self.flush_interval
+        if due:
+            pending = self.take()
+            try:
+                self.client.pipeline(self.counters(pending))
+            except RedisUnavailable, e:
+                self.requeue(pending)
+                logging.warning("Counter flush failed, kept for the next one: " + str(e))
+            except RedisError, e:
+                logging.warning("Counter flush failed: " + str(e))
+
+    def append(self, id, key, value):
+        return self.run(id, [("RPUSH", self.key(id, key), json.dumps(value))], [key])[0]
+
+    def replace(self, id, key, index, value):
+        self.run(id, [("LSET", self.key(id, key), index, json.dumps(value))], [key])
+
+    def items(self, id, key):
+        return [self.decode(item) for item in self.run(id, [("LRANGE", self.key(id, key), 0, -1)])[0]]
+
+    def length(self, id, key):
+        return self.run(id, [("LLEN", self.key(id, key))])[0]
+
+    def add_field(self, id, key, field, value):
+        self.run(id, [("HINCRBY", self.key(id, key), field, value)], [key])
+
+    def set_field(self, id, key, field, value):
+        self.run(id, [("HSET", self.key(id, key), field, json.dumps(value))], [key])
+
+    def fields(self, id, key):
+        reply = self.run(id, [("HGETALL", self.key(id, key))])[0]
+        return dict((reply[i], self.decode(reply[i + 1])) for i in range(0, len(reply), 2))
+
+    def clear(self, id, keys):
+        self.run(id, [("DEL",) + tuple(self.key(id, key) for key in keys)])
+
+    def drop(self, id):
+        """Nothing to do: other processes may still be serving the user, and
+        Redis expires the keys ttl seconds after the last write."""
+        pass
+
+    def ids(self):
+        """Only the users this process has seen are listed; Redis is not scanned."""
+        return []
+
+    def size(self, id):
+        return 0
@@ -13,5 +13,33 @@ geni_app_secret = "*********"
 geni_canvas_id = "http://www.geni.com/platform/apps/*********/"
 geni_namespace = "*********"
 
+geni_pool_size = 30
+geni_max_clients = 200
+geni_rate_limit = 4.0
+geni_rate_burst = 40
+geni_priority_share = 0.5
+geni_cache_mb = 32
+geni_cache_path = "geni_cache.db"
+geni_cache_disk_mb = 256
+geni_batch_limits = {"history": (6, 1, 20), "graph": (50, 5, 100), "unions": (35, 5, 80)}
+geni_batch_latency = 2.0
+geni_denied_ttl = 3600
+geni_page_prefetch = 4
+geni_client_idle = 900
+geni_token_margin = 300
+validate_ttl = 300
+geni_breaker_threshold = 10
+geni_breaker_window = 20
+geni_breaker_slow = 30.0
+geni_breaker_cooldown = 30.0
+geni_slots = 30
+geni_user_slots = 15
+geni_scheduler_quantum = 20
+session_ttl = 3600
+session_budget_mb = 128
+session_sweep = 60
+session_store = None
+session_flush = 0.5
+
 app_url = "localhost:8080"
 debug = True
\ No newline at end of file
@@ -0,0 +1,33 @@
+import unittest
+
+import geni
+
+
+class FamilyFieldsTest(unittest.TestCase):
+    def response(self, fields):
+        """An immediate-family result holding only the requested fields."""
+        def profile(id):
+            values = {"id": id, "name": "Name", "gender": "male", "living": False, "deleted": False,
+                      "public": True, "master_profile": True, "merge_pending": False, "project_ids": []}
+            return dict((k, values[k]) for k in fields.split(","))
+        return {"focus": profile("profile-1"),
+                "nodes": {"profile-1": profile("profile-1"), "profile-2": profile("profile-2"),
+                          "union-3": {"id": "union-3", "edges": {"profile-1": {"rel": "child"}}}}}
+
+    def test_public_always_requested(self):
+        for options in ({}, {"complete": True}, {"project": True}, {"master": True}):
+            self.assertIn("public", geni.family_fields(**options).split(","))
+
+    def test_complete_only_response_is_shared(self):
+        fields = geni.family_fields(complete=True)
+        response = self.response(fields)
+        self.assertTrue(geni.is_shareable(response))
+        cache = geni.ResponseCache()
+        variant = cache.variant({"fields": fields})
+        cache.put("profile/immediate-family", "1", variant, response, "token-a")
+        self.assertEqual(list(cache.entries)[0][3], None)
+        self.assertEqual(cache.get("profile/immediate-family", "1", variant, "token-b"), response)
+
+
+if __name__ == "__main__":
+    unittest.main()
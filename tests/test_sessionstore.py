@@ -0,0 +1,169 @@
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+import sessionstore
+
+
+class StandInRedis(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Enough of a Redis server, in memory, for the commands RedisStore sends."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.connections = []
+        self.commands = []
+
+    def drop_connections(self):
+        """Close every client connection, as a restarted server would."""
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # The client already closed it
+                pass
+        del self.connections[:]
+
+    def command(self, name, args):
+        data = self.data
+        if name == "HSET":
+            table = data.setdefault(args[0], {})
+            for i in range(1, len(args), 2):
+                table[args[i]] = args[i + 1]
+            return (len(args) - 1) / 2
+        if name == "HGET":
+            return data.get(args[0], {}).get(args[1])
+        if name == "HMGET":
+            return [data.get(args[0], {}).get(key) for key in args[1:]]
+        if name == "HINCRBY":
+            table = data.setdefault(args[0], {})
+            table[args[1]] = str(int(table.get(args[1], 0)) + int(args[2]))
+            return int(table[args[1]])
+        if name == "HGETALL":
+            return sum([[key, value] for key, value in data.get(args[0], {}).items()], [])
+        if name == "RPUSH":
+            data.setdefault(args[0], []).append(args[1])
+            return len(data[args[0]])
+        if name == "LSET":
+            data[args[0]][int(args[1])] = args[2]
+            return "OK"
+        if name == "LRANGE":
+            return list(data.get(args[0], []))
+        if name == "LLEN":
+            return len(data.get(args[0], []))
+        if name == "DEL":
+            return sum(1 for key in args if data.pop(key, None) is not None)
+        if name in ("EXPIRE", "SELECT"):
+            return 1
+        return sessionstore.RedisError("ERR unknown command " + name)
+
+
+class StandInHandler(SocketServer.StreamRequestHandler):
+    def encode(self, value):
+        if value is None:
+            return "$-1\r\n"
+        if isinstance(value, sessionstore.RedisError):
+            return "-%s\r\n" % value
+        if isinstance(value, int):
+            return ":%d\r\n" % value
+        if isinstance(value, list):
+            return "*%d\r\n" % len(value) + "".join(self.encode(item) for item in value)
+        if value == "OK":
+            return "+OK\r\n"
+        return "$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for i in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            with self.server.lock:
+                self.server.commands.append(args[0])
+                reply = self.server.command(args[0].upper(), args[1:])
+            try:
+                self.wfile.write(self.encode(reply))
+                self.wfile.flush()
+            except socket.error:
+                return
+
+
+class RedisStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInRedis()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = sessionstore.RedisClient("127.0.0.1", self.server.server_address[1], timeout=2.0)
+        self.store = sessionstore.RedisStore(self.client, flush=60)
+
+    def tearDown(self):
+        for connection in self.client.idle:
+            connection.close()
+        self.server.drop_connections()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_snapshot(self):
+        self.store.update("1", {"running": 1, "stage": "parent"})
+        self.assertEqual(self.store.snapshot("1", ("running", "stage", "hits")),
+                         {"running": 1, "stage": "parent", "hits": None})
+        self.assertEqual(self.store.get("1", "stage"), "parent")
+
+    def test_add_and_flush(self):
+        self.store.add("1", {"count": 2, "hits": 0})
+        self.store.add("1", {"count": 3})
+        self.assertEqual(self.server.data, {})
+        # Reads of the same user send its buffered counters first
+        self.assertEqual(self.store.get("1", "count"), 5)
+        self.store.add("2", {"count": 1})
+        self.store.flush_interval = 0
+        self.store.add("3", {"count": 4})
+        self.assertEqual(self.store.pending, {})
+        self.assertEqual(self.store.snapshot("2", ("count",)), {"count": 1})
+        self.assertEqual(self.store.get("3", "count"), 4)
+
+    def test_failed_flush_keeps_counters(self):
+        self.store.add("1", {"count": 2})
+        self.client.port = self.server.server_address[1] + 1
+        self.store.flush_interval = 0
+        self.store.add("1", {"count": 3})
+        self.assertEqual(self.store.pending, {"1": {"count": 5}})
+        self.client.port = self.server.server_address[1]
+        self.assertEqual(self.store.get("1", "count"), 5)
+
+    def test_append_and_replace(self):
+        self.assertEqual(self.store.append("1", "matches", {"id": 5}), 1)
+        self.assertEqual(self.store.append("1", "matches", {"id": 6}), 2)
+        self.store.replace("1", "matches", 0, {"id": 7})
+        self.assertEqual(self.store.items("1", "matches"), [{"id": 7}, {"id": 6}])
+        self.assertEqual(self.store.length("1", "matches"), 2)
+        self.store.clear("1", ["matches"])
+        self.assertEqual(self.store.items("1", "matches"), [])
+
+    def test_fields(self):
+        self.store.add_field("1", "parents", "2", 1)
+        self.store.add_field("1", "parents", "2", 2)
+        self.store.set_field("1", "seen", "3", True)
+        self.assertEqual(self.store.fields("1", "parents"), {"2": 3})
+        self.assertEqual(self.store.fields("1", "seen"), {"3": True})
+
+    def test_dropped_idle_connection(self):
+        self.store.set("1", "stage", "parent")
+        self.server.drop_connections()
+        time.sleep(0.05)
+        self.assertEqual(self.store.append("1", "matches", {"id": 5}), 1)
+        self.assertEqual(self.server.commands.count("RPUSH"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()